@@ -0,0 +1,392 @@
+from __future__ import print_function
+from datetime import datetime
+from google.protobuf import json_format
+from google.transit import gtfs_realtime_pb2
+import argparse
+import io
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import zipfile
+import psycopg2
+import Columnar
+import Config
+import DBLoader
+import Ingestion
+import SnapshotArchive
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+CONFIG_FILENAME = Config.CONFIG_FILENAME
+CONFIG_SECTION_POSTGRES = 'postgresql'
+STAGES = ('unzip', 'parse', 'transform', 'insert')
+# Share of trips without stop time data, skipped by the transform
+NO_DATA_RATIO = 0.05
+# Scripts launched by cron, timed by --startup
+STARTUP_SCRIPTS = ('DriveDownloader', 'TransitcrunchUpdater')
+SCHEDULED = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate.SCHEDULED
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compares the execute_values and COPY loaders on synthetic rows, "
+            "times each ingestion stage on synthetic archives with --stages, "
+            "or checks the cold start of the scripts with --startup.")
+    parser.add_argument('--rows', type=int, default=50000,
+        help="number of stop_time_update rows to insert per run")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="number of runs per loader mode, or of the whole --stages run")
+    parser.add_argument('--stages', action='store_true',
+        help="time unzip, parse, transform and insert on a synthetic archive")
+    parser.add_argument('--format', choices=['json', 'gtfsrt'], default='json',
+        help="archive format for --stages: a Drive zip of JSON feeds or a snapshot archive")
+    parser.add_argument('--snapshots', type=int, default=20,
+        help="tripupdates/vehiclepositions snapshot pairs in the archive")
+    parser.add_argument('--trips', type=int, default=1200,
+        help="trips per tripupdates snapshot")
+    parser.add_argument('--stops', type=int, default=25,
+        help="stop time updates per trip")
+    parser.add_argument('--vehicles', type=int, default=900,
+        help="vehicles per vehiclepositions snapshot")
+    parser.add_argument('--sink', choices=['null', 'postgres'], default='null',
+        help="where --stages inserts: formatted and discarded, or the configured database, "
+            "rolled back after each run")
+    parser.add_argument('--mode', choices=[DBLoader.LOADER_VALUES, DBLoader.LOADER_COPY,
+        DBLoader.LOADER_ARROW], default=DBLoader.LOADER_COPY,
+        help="loader used by --stages; the null sink always formats rows for COPY")
+    parser.add_argument('--startup', action='store_true',
+        help="time a cold start of each script, failing past --budget")
+    parser.add_argument('--budget', type=float, default=1.0,
+        help="seconds a cold start of a script may take with --startup")
+    args = parser.parse_args()
+    if args.startup:
+        if not benchmarkStartup(args.repeat, args.budget):
+            sys.exit(1)
+        return
+    if args.stages:
+        archive = syntheticArchive(args.format, args.snapshots, args.trips, args.stops, args.vehicles)
+        postGresConfig = None
+        if args.sink == 'postgres':
+            postGresConfig = Config.readConfig(CONFIG_SECTION_POSTGRES, CONFIG_FILENAME)
+        benchmarkStages(archive, args.format, postGresConfig, args.mode, args.repeat)
+        return
+    postGresConfig = Config.readConfig(CONFIG_SECTION_POSTGRES, CONFIG_FILENAME)
+    benchmarkLoaders(postGresConfig, args.rows, args.repeat)
+
+def syntheticStopTimeUpdates(count):
+    now = int(time.time())
+    rows = []
+    for i in range(count):
+        tripUpdateId = i // 30
+        rows.append((
+            str(50000 + i % 9000),
+            i % 30 + 1,
+            tripUpdateId,
+            datetime.utcfromtimestamp(now + i % 3600),
+            datetime.utcfromtimestamp(now + i % 3600 - 30),
+            'SCHEDULED',
+            datetime.utcfromtimestamp(now),
+            None
+        ))
+    return rows
+
+def benchmarkLoaders(postGresConfig, count, repeat):
+    rows = syntheticStopTimeUpdates(count)
+    # Loads into a temporary copy of stop_time_update so the real table is
+    # never touched; it is dropped with the connection.
+    table = 'bench_stop_time_update'
+    conn = psycopg2.connect(**postGresConfig)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("CREATE TEMP TABLE {0} (LIKE {1} INCLUDING DEFAULTS)".format(
+                table, DBLoader.STOP_TIME_UPDATE_TABLE))
+        for mode in (DBLoader.LOADER_VALUES, DBLoader.LOADER_COPY):
+            timings = []
+            for i in range(repeat):
+                with conn.cursor() as cur:
+                    start = time.perf_counter()
+                    DBLoader.loadRows(cur, table, DBLoader.STOP_TIME_UPDATE_COLUMNS, rows, mode)
+                    conn.commit()
+                    timings.append(time.perf_counter() - start)
+                    cur.execute("TRUNCATE {0}".format(table))
+                    conn.commit()
+            best = min(timings)
+            print("{0:>6}: {1} rows in {2:.3f}s (best of {3}), {4:.0f} rows/s".format(
+                mode, count, best, repeat, count / best))
+    finally:
+        conn.close()
+
+def syntheticFeeds(timestamp, trips, stops, vehicles):
+    """
+    A tripupdates and a vehiclepositions FeedMessage shaped like the STM
+    feeds: numeric trip and stop IDs, arrival and departure times spread over
+    the next hours and positions around Montreal.
+    """
+    tripFeed = gtfs_realtime_pb2.FeedMessage()
+    tripFeed.header.gtfs_realtime_version = '2.0'
+    tripFeed.header.timestamp = timestamp
+    for i in range(trips):
+        entity = tripFeed.entity.add()
+        entity.id = str(i)
+        tripUpdate = entity.trip_update
+        tripUpdate.trip.trip_id = str(190000000 + i)
+        tripUpdate.trip.start_date = datetime.utcfromtimestamp(timestamp).strftime('%Y%m%d')
+        tripUpdate.trip.start_time = '{0:02d}:{1:02d}:00'.format(5 + i % 19, i % 60)
+        tripUpdate.trip.route_id = str(1 + i % 220)
+        tripUpdate.timestamp = timestamp - random.randint(0, 60)
+        noData = random.random() < NO_DATA_RATIO
+        departure = timestamp + random.randint(0, 3600)
+        for j in range(stops):
+            stopTimeUpdate = tripUpdate.stop_time_update.add()
+            stopTimeUpdate.stop_sequence = j + 1
+            stopTimeUpdate.stop_id = str(50000 + (i * 7 + j) % 9000)
+            if noData:
+                stopTimeUpdate.schedule_relationship = Ingestion.NO_DATA
+                continue
+            stopTimeUpdate.schedule_relationship = SCHEDULED
+            departure += random.randint(40, 150)
+            if j > 0:
+                stopTimeUpdate.arrival.time = departure - 10
+            stopTimeUpdate.departure.time = departure
+    vehicleFeed = gtfs_realtime_pb2.FeedMessage()
+    vehicleFeed.header.gtfs_realtime_version = '2.0'
+    vehicleFeed.header.timestamp = timestamp
+    for i in range(vehicles):
+        entity = vehicleFeed.entity.add()
+        entity.id = str(i)
+        vehicle = entity.vehicle
+        vehicle.vehicle.id = str(20000 + i)
+        vehicle.trip.trip_id = str(190000000 + i)
+        vehicle.current_stop_sequence = 1 + i % stops
+        vehicle.current_status = i % 3
+        vehicle.position.latitude = 45.5 + random.uniform(-0.2, 0.2)
+        vehicle.position.longitude = -73.6 + random.uniform(-0.3, 0.3)
+        vehicle.timestamp = timestamp - random.randint(0, 30)
+    return tripFeed, vehicleFeed
+
+def syntheticArchive(format, snapshots, trips, stops, vehicles):
+    """
+    Bytes of an archive holding the given number of snapshot pairs, 30
+    seconds apart: a zip of MessageToJson files like the Drive archives, or a
+    snapshot archive.
+    """
+    start = int(time.time()) - snapshots * 30
+    feeds = []
+    for i in range(snapshots):
+        timestamp = start + i * 30
+        tripFeed, vehicleFeed = syntheticFeeds(timestamp, trips, stops, vehicles)
+        feeds.append(('tripupdates', timestamp, tripFeed))
+        feeds.append(('vehiclepositions', timestamp, vehicleFeed))
+    if format == 'gtfsrt':
+        # SnapshotWriter only writes to files
+        fd, path = tempfile.mkstemp(suffix=SnapshotArchive.SNAPSHOT_EXTENSION)
+        os.close(fd)
+        try:
+            writer = SnapshotArchive.SnapshotWriter(path)
+            for feedType, timestamp, feed in feeds:
+                writer.add(feedType, timestamp, feed.SerializeToString())
+            writer.close()
+            with open(path, 'rb') as f:
+                return f.read()
+        finally:
+            os.remove(path)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zip_ref:
+        for feedType, timestamp, feed in feeds:
+            zip_ref.writestr('{0}_{1}.json'.format(feedType, timestamp),
+                json_format.MessageToJson(feed))
+    return buffer.getvalue()
+
+class NullCursor:
+    """Cursor of the null sink: COPY data is formatted, counted and dropped."""
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def copy_expert(self, query, buffer):
+        self.connection.bytes += len(buffer.getvalue())
+
+class NullConnection:
+    def __init__(self):
+        self.bytes = 0
+
+    def cursor(self):
+        return NullCursor(self)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+class NullIdAllocator:
+    def __init__(self):
+        self.next = 1
+
+    def reserve(self, conn, count):
+        ids = list(range(self.next, self.next + count))
+        self.next += count
+        return ids
+
+def readSnapshots(archive, format):
+    """(name, content) of every snapshot of the archive."""
+    if format == 'gtfsrt':
+        reader = SnapshotArchive.SnapshotReader(archive)
+        return [(SnapshotArchive.snapshotName(entry), content)
+            for entry, content in reader.snapshots()]
+    with zipfile.ZipFile(io.BytesIO(archive), 'r') as zip_ref:
+        return [(name, zip_ref.read(name)) for name in zip_ref.namelist()]
+
+def parseSnapshot(content, format):
+    if format == 'gtfsrt':
+        return Ingestion.parseFeed(content)
+    return Ingestion.JsonFeed(content)
+
+def insertRows(name, rows, conn, tripUpdateIds, mode):
+    with conn.cursor() as cur:
+        if Ingestion.feedTypeOf(name) == 'tripupdates':
+            paramsTripUpdate, paramsStopUpdate = Ingestion.assignTripUpdateIds(
+                rows, conn, tripUpdateIds)
+            DBLoader.loadRows(cur, DBLoader.TRIP_UPDATE_TABLE, DBLoader.TRIP_UPDATE_COLUMNS,
+                paramsTripUpdate, mode)
+            DBLoader.loadRows(cur, DBLoader.STOP_TIME_UPDATE_TABLE, DBLoader.STOP_TIME_UPDATE_COLUMNS,
+                paramsStopUpdate, mode)
+            return len(paramsTripUpdate) + len(paramsStopUpdate)
+        DBLoader.loadRows(cur, DBLoader.VEHICLE_POSITION_TABLE, DBLoader.VEHICLE_POSITION_COLUMNS,
+            rows, mode)
+        return len(rows)
+
+def transformTables(name, feed, conn, tripUpdateIds):
+    """(table, Arrow table) pairs of a feed, built by the columnar transform."""
+    tables = []
+    if Ingestion.feedTypeOf(name) == 'tripupdates':
+        for trips, stops in Columnar.tripUpdateTables(feed, conn, tripUpdateIds):
+            tables.append((DBLoader.TRIP_UPDATE_TABLE, trips))
+            tables.append((DBLoader.STOP_TIME_UPDATE_TABLE, stops))
+    else:
+        for vehicles in Columnar.vehiclePositionTables(feed):
+            tables.append((DBLoader.VEHICLE_POSITION_TABLE, vehicles))
+    return tables
+
+def insertTables(tables, conn):
+    with conn.cursor() as cur:
+        for table, data in tables:
+            Columnar.copyTable(cur, table, data)
+    return sum(data.num_rows for table, data in tables)
+
+def runStages(archive, format, conn, tripUpdateIds, mode):
+    """Seconds spent in each stage, the bytes each stage read, and the rows inserted."""
+    timings = dict((stage, 0.0) for stage in STAGES)
+    started = time.perf_counter()
+    snapshots = readSnapshots(archive, format)
+    timings['unzip'] = time.perf_counter() - started
+    feedBytes = sum(len(content) for name, content in snapshots)
+    rowCount = 0
+    for name, content in snapshots:
+        started = time.perf_counter()
+        feed = parseSnapshot(content, format)
+        parsed = time.perf_counter()
+        # With ijson, JSON entities are only parsed here, as rows are built
+        if mode == DBLoader.LOADER_ARROW:
+            tables = transformTables(name, feed, conn, tripUpdateIds)
+        elif Ingestion.feedTypeOf(name) == 'tripupdates':
+            rows = list(Ingestion.tripUpdateRows(feed))
+        else:
+            rows = list(Ingestion.vehiclePositionRows(feed))
+        transformed = time.perf_counter()
+        if mode == DBLoader.LOADER_ARROW:
+            rowCount += insertTables(tables, conn)
+        else:
+            rowCount += insertRows(name, rows, conn, tripUpdateIds, mode)
+        inserted = time.perf_counter()
+        timings['parse'] += parsed - started
+        timings['transform'] += transformed - parsed
+        timings['insert'] += inserted - transformed
+    volumes = {'unzip': len(archive), 'parse': feedBytes, 'transform': feedBytes, 'insert': None}
+    return timings, volumes, rowCount
+
+def benchmarkStages(archive, format, postGresConfig, mode, repeat):
+    if mode == DBLoader.LOADER_ARROW:
+        Columnar.requirePyarrow()
+    conn = NullConnection()
+    tripUpdateIds = NullIdAllocator()
+    if postGresConfig is not None:
+        # Each run is rolled back, so the tables are left as they were. The
+        # sequence is created beforehand since that commits.
+        conn = psycopg2.connect(**postGresConfig)
+        tripUpdateIds = DBLoader.IdAllocator(DBLoader.LOADER_DEFAULTS['idblocksize'])
+        tripUpdateIds.prepare(conn)
+    elif mode != DBLoader.LOADER_ARROW:
+        mode = DBLoader.LOADER_COPY
+    try:
+        best = None
+        for i in range(repeat):
+            if postGresConfig is None:
+                conn.bytes = 0
+            timings, volumes, rowCount = runStages(archive, format, conn, tripUpdateIds, mode)
+            conn.rollback()
+            if best is None or sum(timings.values()) < sum(best.values()):
+                best = timings
+                # The null sink measures the COPY data it was sent
+                volumes['insert'] = conn.bytes if postGresConfig is None else None
+                bestVolumes = volumes
+    finally:
+        if postGresConfig is not None:
+            conn.close()
+    print("{0} archive of {1:.1f} MB, {2} rows (best of {3}, {4} sink, {5} loader)".format(
+        format, len(archive) / 1e6, rowCount, repeat,
+        'postgres' if postGresConfig is not None else 'null', mode))
+    for stage in STAGES:
+        seconds = max(best[stage], 1e-9)
+        throughput = ''
+        if bestVolumes[stage] is not None:
+            throughput = ", {0:.2f} MB/s".format(bestVolumes[stage] / 1e6 / seconds)
+        print("{0:>9}: {1:.3f}s, {2:.0f} rows/s{3}".format(
+            stage, best[stage], rowCount / seconds, throughput))
+    total = sum(best.values())
+    print("{0:>9}: {1:.3f}s, {2:.0f} rows/s".format('total', total, rowCount / total))
+    print("Peak RSS: {0}".format(peakRss()))
+
+def benchmarkStartup(repeat, budget):
+    """
+    Times a fresh interpreter importing each script, and building the Drive
+    service from the cached discovery document when there is one. Returns
+    False if any of them takes longer than the budget.
+    """
+    withinBudget = True
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for script in STARTUP_SCRIPTS:
+        code = "import " + script
+        if script == 'DriveDownloader':
+            code += ("\nimport httplib2, os\nif os.path.exists(DriveDownloader.DISCOVERY_CACHE):\n"
+                "    DriveDownloader.build_from_document(open(DriveDownloader.DISCOVERY_CACHE).read(),"
+                " http=httplib2.Http())")
+        best = min(timeProcess([sys.executable, '-c', code], directory) for i in range(repeat))
+        withinBudget = withinBudget and best <= budget
+        print("{0:>20}: {1:.3f}s (best of {2}, budget {3:.3f}s){4}".format(
+            script, best, repeat, budget, '' if best <= budget else ' OVER BUDGET'))
+    return withinBudget
+
+def timeProcess(command, directory):
+    started = time.perf_counter()
+    subprocess.check_call(command, cwd=directory)
+    return time.perf_counter() - started
+
+def peakRss():
+    if resource is None:
+        return 'n/a'
+    # ru_maxrss is in kilobytes on Linux
+    return "{0:.0f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,352 @@
+"""
+Columnar transform of the feeds, used by the arrow loader and the Parquet
+export. Needs the optional numpy and pyarrow packages.
+
+The entities of a batch are walked once into plain lists of raw values, then
+turned into Arrow tables in bulk: epoch seconds become timestamps in a single
+cast instead of one datetime per value, and every stop gets the
+trip_update_id and created_at of its trip through one numpy.repeat. The same
+tables are streamed to Postgres with COPY, in CSV format, and written as
+Parquet files partitioned by date.
+"""
+from uuid import uuid4
+import io
+import os
+import DBLoader
+import Ingestion
+import Metrics
+
+# Imported by requirePyarrow on first use, as they take longer to import
+# than the rest of the scripts together
+numpy = None
+pyarrow = None
+
+CONFIG_SECTION_PARQUET = 'parquet'
+PARQUET_DEFAULTS = {
+    # Directory of the Parquet dataset, empty to disable the export
+    'path': '',
+    # Also insert the rows in the database. trip_update IDs are reserved
+    # from the sequence either way, so both stay joinable.
+    'database': True
+}
+PARTITION_COLUMN = 'date'
+COLUMNS = {
+    DBLoader.TRIP_UPDATE_TABLE: DBLoader.TRIP_UPDATE_COLUMNS,
+    DBLoader.STOP_TIME_UPDATE_TABLE: DBLoader.STOP_TIME_UPDATE_COLUMNS,
+    DBLoader.VEHICLE_POSITION_TABLE: DBLoader.VEHICLE_POSITION_COLUMNS
+}
+# Arrow types of the columns above. start_time stays text, as GTFS start
+# times can go past 24:00:00.
+COLUMN_TYPES = {
+    DBLoader.TRIP_UPDATE_TABLE: ('int64', 'string', 'string', 'string', 'timestamp[s]'),
+    DBLoader.STOP_TIME_UPDATE_TABLE: ('string', 'int64', 'int64', 'timestamp[s]',
+        'timestamp[s]', 'string', 'timestamp[s]', 'int64'),
+    DBLoader.VEHICLE_POSITION_TABLE: ('string', 'string', 'int64', 'string', 'double',
+        'double', 'timestamp[s]')
+}
+# Enum names indexed by their value, to label a whole column at once
+SCHEDULE_RELATIONSHIP_NAMES = [Ingestion.SCHEDULE_RELATIONSHIPS.get(value)
+    for value in range(max(Ingestion.SCHEDULE_RELATIONSHIPS) + 1)]
+VEHICLE_STOP_STATUS_NAMES = [Ingestion.VEHICLE_STOP_STATUSES.get(value)
+    for value in range(max(Ingestion.VEHICLE_STOP_STATUSES) + 1)]
+
+class ParquetExport:
+    """
+    Writes Arrow tables under <path>/<table>/date=<YYYY-MM-DD>/, one new file
+    per table and batch, so concurrent writers never share a file.
+    """
+    def __init__(self, path, database=True):
+        self.path = path
+        self.database = database
+
+    def write(self, table, data, tablePrefix=''):
+        if data.num_rows == 0:
+            return
+        table = DBLoader.prefixedTable(table, tablePrefix)
+        data = data.append_column(PARTITION_COLUMN,
+            data.column('created_at').cast(pyarrow.date32()))
+        with Metrics.timed('export'):
+            pyarrow.parquet.write_to_dataset(data, os.path.join(self.path, table.split('.')[-1]),
+                partition_cols=[PARTITION_COLUMN], basename_template=uuid4().hex + '-{i}.parquet')
+        Metrics.increment('rows_exported_total', data.num_rows, table=table)
+
+    def writeRows(self, table, rows, tablePrefix=''):
+        """Same as write, for row tuples built by Ingestion."""
+        if rows:
+            self.write(table, buildTable(table, list(zip(*rows))), tablePrefix)
+
+class TripColumns:
+    """Raw values of the trips of a batch and of their stops, column by column."""
+    def __init__(self, fromFeed, staticGtfs=None):
+        # Enums are values in a FeedMessage and names in the JSON files
+        self.fromFeed = fromFeed
+        self.staticGtfs = staticGtfs
+        self.tripIds = []
+        self.startTimes = []
+        self.routeIds = []
+        self.timestamps = []
+        self.stopCounts = []
+        self.stopIds = []
+        self.stopSequences = []
+        self.departures = []
+        self.arrivals = []
+        self.relationships = []
+        self.stopTimeIds = []
+
+    def __len__(self):
+        return len(self.tripIds)
+
+    def scheduledTrip(self, tripId, routeId):
+        if self.staticGtfs is None:
+            return None
+        return self.staticGtfs.trip(tripId, routeId)
+
+    def stopTimeId(self, scheduledTrip, stopSequence, stopId):
+        if scheduledTrip is None:
+            return None
+        return self.staticGtfs.stopTimeId(scheduledTrip, stopSequence, stopId)
+
+    def changedTrips(self, tripDedup=None):
+        """Indexes of the trips that changed since they were last ingested."""
+        if tripDedup is None:
+            return numpy.arange(len(self))
+        trips = []
+        end = 0
+        for index, count in enumerate(self.stopCounts):
+            start, end = end, end + count
+            digest = hash((self.routeIds[index], tuple(self.stopIds[start:end]),
+                tuple(self.stopSequences[start:end]), tuple(self.departures[start:end]),
+                tuple(self.arrivals[start:end]), tuple(self.relationships[start:end])))
+            trips.append(((self.tripIds[index], self.startTimes[index]),
+                self.timestamps[index], digest, index))
+        return numpy.array(tripDedup.filter(trips), dtype=numpy.int64)
+
+    def tables(self, kept, ids):
+        """
+        trip_update and stop_time_update tables of the kept trips, numbered
+        with ids in order.
+        """
+        counts = numpy.array(self.stopCounts, dtype=numpy.int64)
+        tripOfStop = numpy.repeat(numpy.arange(len(counts)), counts)
+        keptTrips = numpy.zeros(len(counts), dtype=bool)
+        keptTrips[kept] = True
+        tripUpdateIds = numpy.zeros(len(counts), dtype=numpy.int64)
+        tripUpdateIds[kept] = ids
+        createdAt = timestampArray(self.timestamps)
+        relationships = self.relationships
+        if self.fromFeed:
+            relationships = labelArray(relationships, SCHEDULE_RELATIONSHIP_NAMES)
+        trips = buildTable(DBLoader.TRIP_UPDATE_TABLE, [tripUpdateIds, self.tripIds,
+            self.startTimes, self.routeIds, createdAt])
+        stops = buildTable(DBLoader.STOP_TIME_UPDATE_TABLE, [self.stopIds, self.stopSequences,
+            tripUpdateIds[tripOfStop], timestampArray(self.departures),
+            timestampArray(self.arrivals), relationships, createdAt.take(pyarrow.array(tripOfStop)),
+            self.stopTimeIds])
+        return trips.filter(pyarrow.array(keptTrips)), stops.filter(pyarrow.array(keptTrips[tripOfStop]))
+
+def requirePyarrow():
+    global numpy, pyarrow
+    if pyarrow is not None:
+        return
+    try:
+        import numpy
+        import pyarrow
+        import pyarrow.csv
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('The arrow loader and the Parquet export need the numpy and pyarrow packages')
+
+def createExport(parquetConfig):
+    if not parquetConfig['path']:
+        return None
+    requirePyarrow()
+    return ParquetExport(parquetConfig['path'], parquetConfig['database'])
+
+def isUsed(loaderMode, export=None):
+    """Whether feeds go through this module rather than the row path of Ingestion."""
+    return loaderMode == DBLoader.LOADER_ARROW or export is not None
+
+def insertFeed(name, feed, conn, tripUpdateIds, tripDedup=None,
+               batchSize=DBLoader.LOADER_DEFAULTS['batchsize'], latest=None, export=None,
+               staticGtfs=None, tablePrefix=''):
+    """
+    Same as Ingestion.insertFeed, through the columnar transform: the rows
+    are COPYed from Arrow tables and, with an export, written as Parquet.
+    """
+    requirePyarrow()
+    feedType = Ingestion.feedTypeOf(name)
+    if feedType is None:
+        return False
+    with Metrics.timed('insert'):
+        if feedType == "tripupdates":
+            insertTripUpdates(feed, conn, tripUpdateIds, tripDedup, batchSize, latest, export,
+                staticGtfs, tablePrefix)
+        else:
+            insertVehiclePositions(feed, conn, batchSize, latest, export, tablePrefix)
+    Metrics.increment('feeds_inserted_total', feed=feedType)
+    return True
+
+def insertTripUpdates(feed, conn, tripUpdateIds, tripDedup=None,
+                      batchSize=DBLoader.LOADER_DEFAULTS['batchsize'], latest=None, export=None,
+                      staticGtfs=None, tablePrefix=''):
+    for trips, stops in tripUpdateTables(feed, conn, tripUpdateIds, tripDedup, batchSize,
+            staticGtfs):
+        with conn.cursor() as cur:
+            storeTable(cur, DBLoader.TRIP_UPDATE_TABLE, trips, export, tablePrefix)
+            storeTable(cur, DBLoader.STOP_TIME_UPDATE_TABLE, stops, export, tablePrefix)
+            if latest is not None and (export is None or export.database):
+                latest.addStopTimes(tableRows(trips), tableRows(stops))
+
+def insertVehiclePositions(feed, conn, batchSize=DBLoader.LOADER_DEFAULTS['batchsize'],
+                           latest=None, export=None, tablePrefix=''):
+    for vehicles in vehiclePositionTables(feed, batchSize):
+        with conn.cursor() as cur:
+            storeTable(cur, DBLoader.VEHICLE_POSITION_TABLE, vehicles, export, tablePrefix)
+            if latest is not None and (export is None or export.database):
+                latest.addVehicles(tableRows(vehicles))
+
+def storeTable(cur, table, data, export=None, tablePrefix=''):
+    if export is None or export.database:
+        copyTable(cur, DBLoader.prefixedTable(table, tablePrefix), data)
+    if export is not None:
+        export.write(table, data, tablePrefix)
+
+def copyTable(cur, table, data):
+    # Strings are always quoted by the CSV writer, so only NULLs are left
+    # empty and unquoted, which is how COPY reads NULL in CSV format.
+    buffer = io.BytesIO()
+    pyarrow.csv.write_csv(data, buffer, pyarrow.csv.WriteOptions(include_header=False))
+    buffer.seek(0)
+    DBLoader.copyCsv(cur, table, data.column_names, buffer, data.num_rows)
+
+def tableRows(data):
+    return list(zip(*[column.to_pylist() for column in data.columns]))
+
+def tripUpdateTables(feed, conn, tripUpdateIds, tripDedup=None,
+                     batchSize=DBLoader.LOADER_DEFAULTS['batchsize'], staticGtfs=None):
+    """
+    Yields the trip_update and stop_time_update tables of a feed, batchSize
+    entities at a time, with the unchanged trips dropped and the others
+    numbered from the trip_update sequence.
+    """
+    requirePyarrow()
+    fromFeed = not isinstance(feed, Ingestion.JsonFeed)
+    entities = feed.entity if fromFeed else feed.entities()
+    collect = collectTripUpdatesFromFeed if fromFeed else collectTripUpdatesFromJson
+    tripCount = 0
+    for batch in Ingestion.batched(entities, batchSize):
+        columns = TripColumns(fromFeed, staticGtfs)
+        collect(batch, columns)
+        tripCount += len(columns)
+        kept = columns.changedTrips(tripDedup)
+        ids = tripUpdateIds.reserve(conn, len(kept))
+        yield columns.tables(kept, ids)
+    if tripDedup is not None:
+        tripDedup.resize(tripCount)
+
+def vehiclePositionTables(feed, batchSize=DBLoader.LOADER_DEFAULTS['batchsize']):
+    requirePyarrow()
+    fromFeed = not isinstance(feed, Ingestion.JsonFeed)
+    entities = feed.entity if fromFeed else feed.entities()
+    for batch in Ingestion.batched(entities, batchSize):
+        if fromFeed:
+            yield vehiclePositionTableFromFeed(batch)
+        else:
+            yield vehiclePositionTableFromJson(batch)
+
+def collectTripUpdatesFromJson(entities, columns):
+    # Same trips and values as Ingestion.tripUpdateRowsFromJson
+    for en in entities:
+        tripUp = en['tripUpdate']
+        stopTimeUpdates = tripUp["stopTimeUpdate"]
+        if stopTimeUpdates[0]['scheduleRelationship'] == 'NO_DATA':
+            continue
+        trip = tripUp['trip']
+        columns.tripIds.append(trip['tripId'])
+        columns.startTimes.append(trip['startDate'] + ' ' + trip['startTime'])
+        columns.routeIds.append(trip['routeId'])
+        columns.timestamps.append(tripUp.get('timestamp'))
+        columns.stopCounts.append(len(stopTimeUpdates))
+        scheduledTrip = columns.scheduledTrip(trip['tripId'], trip['routeId'])
+        for stopTimeUpdate in stopTimeUpdates:
+            columns.stopIds.append(stopTimeUpdate['stopId'])
+            columns.stopSequences.append(stopTimeUpdate['stopSequence'])
+            columns.stopTimeIds.append(columns.stopTimeId(scheduledTrip,
+                stopTimeUpdate['stopSequence'], stopTimeUpdate['stopId']))
+            columns.departures.append(stopTimeUpdate['departure']['time']
+                if 'departure' in stopTimeUpdate else None)
+            columns.arrivals.append(stopTimeUpdate['arrival']['time']
+                if 'arrival' in stopTimeUpdate else None)
+            columns.relationships.append(stopTimeUpdate['scheduleRelationship'])
+
+def collectTripUpdatesFromFeed(entities, columns):
+    for en in entities:
+        if not en.HasField('trip_update'):
+            continue
+        tripUp = en.trip_update
+        stopTimeUpdates = tripUp.stop_time_update
+        if not stopTimeUpdates or stopTimeUpdates[0].schedule_relationship == Ingestion.NO_DATA:
+            continue
+        trip = tripUp.trip
+        columns.tripIds.append(trip.trip_id)
+        columns.startTimes.append(trip.start_date + ' ' + trip.start_time)
+        columns.routeIds.append(trip.route_id)
+        columns.timestamps.append(tripUp.timestamp if tripUp.HasField('timestamp') else None)
+        columns.stopCounts.append(len(stopTimeUpdates))
+        scheduledTrip = columns.scheduledTrip(trip.trip_id, trip.route_id)
+        for stopTimeUpdate in stopTimeUpdates:
+            columns.stopIds.append(stopTimeUpdate.stop_id)
+            columns.stopSequences.append(stopTimeUpdate.stop_sequence)
+            columns.stopTimeIds.append(columns.stopTimeId(scheduledTrip,
+                stopTimeUpdate.stop_sequence, stopTimeUpdate.stop_id))
+            columns.departures.append(stopTimeUpdate.departure.time
+                if stopTimeUpdate.HasField('departure') else None)
+            columns.arrivals.append(stopTimeUpdate.arrival.time
+                if stopTimeUpdate.HasField('arrival') else None)
+            columns.relationships.append(stopTimeUpdate.schedule_relationship)
+
+def vehiclePositionTableFromJson(entities):
+    vehicles = [en['vehicle'] for en in entities]
+    return buildTable(DBLoader.VEHICLE_POSITION_TABLE, [
+        [vehicle['vehicle']['id'] for vehicle in vehicles],
+        [vehicle['trip']['tripId'] for vehicle in vehicles],
+        [vehicle['currentStopSequence'] for vehicle in vehicles],
+        [vehicle['currentStatus'] for vehicle in vehicles],
+        [vehicle['position']['latitude'] for vehicle in vehicles],
+        [vehicle['position']['longitude'] for vehicle in vehicles],
+        timestampArray([vehicle['timestamp'] for vehicle in vehicles])])
+
+def vehiclePositionTableFromFeed(entities):
+    vehicles = [en.vehicle for en in entities if en.HasField('vehicle')]
+    return buildTable(DBLoader.VEHICLE_POSITION_TABLE, [
+        [vehicle.vehicle.id for vehicle in vehicles],
+        [vehicle.trip.trip_id for vehicle in vehicles],
+        [vehicle.current_stop_sequence for vehicle in vehicles],
+        labelArray([vehicle.current_status for vehicle in vehicles], VEHICLE_STOP_STATUS_NAMES),
+        shortestFloats([vehicle.position.latitude for vehicle in vehicles]),
+        shortestFloats([vehicle.position.longitude for vehicle in vehicles]),
+        timestampArray([vehicle.timestamp for vehicle in vehicles])])
+
+def buildTable(table, columns):
+    schema = pyarrow.schema([(name, pyarrow.type_for_alias(type))
+        for name, type in zip(COLUMNS[table], COLUMN_TYPES[table])])
+    arrays = [column if isinstance(column, pyarrow.Array) else pyarrow.array(column, field.type)
+        for column, field in zip(columns, schema)]
+    return pyarrow.Table.from_arrays(arrays, schema=schema)
+
+def timestampArray(values):
+    # Epoch seconds, ints in a FeedMessage and strings in the JSON files,
+    # converted in one cast. None stays NULL.
+    array = pyarrow.array(values)
+    if pyarrow.types.is_null(array.type):
+        return pyarrow.nulls(len(array), pyarrow.timestamp('s'))
+    return array.cast(pyarrow.int64()).cast(pyarrow.timestamp('s'))
+
+def labelArray(values, names):
+    return pyarrow.array(numpy.array(names, dtype=object)[numpy.array(values, dtype=numpy.int64)],
+        pyarrow.string())
+
+def shortestFloats(values):
+    # Vectorized Ingestion.shortestFloat: numpy prints float32 values as the
+    # shortest decimal that rounds back to them.
+    return numpy.array(values, dtype=numpy.float32).astype(str).astype(numpy.float64)
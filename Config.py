@@ -0,0 +1,31 @@
+"""
+Reads the sections of database.ini, shared by every script.
+"""
+from configparser import ConfigParser
+
+CONFIG_FILENAME = "database.ini"
+
+def readConfig(section, filename=CONFIG_FILENAME, defaults=None):
+    """
+    The values of a section. With defaults the section is optional: missing
+    keys fall back to the defaults, and values are converted to the type of
+    their default. Without, the section is required and values are strings.
+    """
+    parser = ConfigParser()
+    parser.read(filename)
+    if defaults is not None:
+        return sectionValues(parser, section, defaults)
+    if not parser.has_section(section):
+        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
+    return dict(parser.items(section))
+
+def sectionValues(parser, section, defaults):
+    sectionParams = dict(defaults)
+    if parser.has_section(section):
+        for key, value in parser.items(section):
+            if isinstance(defaults.get(key), bool):
+                value = parser.getboolean(section, key)
+            elif key in defaults and defaults[key] is not None:
+                value = type(defaults[key])(value)
+            sectionParams[key] = value
+    return sectionParams
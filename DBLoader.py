@@ -0,0 +1,256 @@
+from psycopg2 import extras
+from psycopg2 import pool
+from contextlib import contextmanager
+from datetime import datetime
+from threading import BoundedSemaphore
+from threading import Lock
+import io
+import math
+import re
+import Metrics
+
+CONFIG_SECTION_LOADER = 'loader'
+# "values" sends multi-row INSERT statements through execute_values,
+# "copy" streams the rows through COPY FROM STDIN. "arrow" builds the rows
+# as Arrow tables (see Columnar.py) and streams them through COPY as CSV.
+LOADER_VALUES = 'values'
+LOADER_COPY = 'copy'
+LOADER_ARROW = 'arrow'
+# "feed" commits every feed on its own, "archive" loads all the feeds of
+# a Drive zip in a single transaction.
+TRANSACTION_FEED = 'feed'
+TRANSACTION_ARCHIVE = 'archive'
+LOADER_DEFAULTS = {
+    'mode': LOADER_VALUES,
+    'poolsize': 4,
+    'transaction': TRANSACTION_FEED,
+    # Number of trip_update IDs reserved from the sequence per round trip
+    'idblocksize': 1000,
+    # Entities turned into rows and sent to the database at once
+    'batchsize': 1000,
+    # Also keep vehicle_latest and stop_time_latest up to date
+    'latest': True
+}
+VALUES_PAGE_SIZE = 200
+
+TRIP_UPDATE_TABLE = 'public.trip_update'
+TRIP_UPDATE_COLUMNS = (
+    'trip_update_id',
+    'trip_id',
+    'start_time',
+    'route_id',
+    'created_at')
+STOP_TIME_UPDATE_TABLE = 'public.stop_time_update'
+STOP_TIME_UPDATE_COLUMNS = (
+    'stop_id',
+    'stop_sequence',
+    'trip_update_id',
+    'departure_time',
+    'arrival_time',
+    'schedule_relationship',
+    'created_at',
+    # Row of the stop time in the static GTFS, see StaticGtfs.py
+    'stop_time_id')
+VEHICLE_POSITION_TABLE = 'public.vehicle_position'
+VEHICLE_POSITION_COLUMNS = (
+    'vehicle_id',
+    'trip_id',
+    'current_stop_sequence',
+    'current_status',
+    'vehicle_lat',
+    'vehicle_lon',
+    'created_at')
+
+# Latest state of each vehicle and of each (trip, stop), upserted along with
+# the history tables.
+VEHICLE_LATEST_TABLE = 'public.vehicle_latest'
+VEHICLE_LATEST_COLUMNS = VEHICLE_POSITION_COLUMNS
+VEHICLE_LATEST_KEY = ('vehicle_id',)
+STOP_TIME_LATEST_TABLE = 'public.stop_time_latest'
+STOP_TIME_LATEST_COLUMNS = (
+    'trip_id',
+    'start_time',
+    'stop_sequence',
+    'stop_id',
+    'route_id',
+    'trip_update_id',
+    'departure_time',
+    'arrival_time',
+    'schedule_relationship',
+    'created_at')
+STOP_TIME_LATEST_KEY = ('trip_id', 'start_time', 'stop_sequence')
+# Feeds of other agencies go to copies of the tables named with a prefix,
+# e.g. public.rtm_trip_update. The prefix is pasted into SQL, so it is limited
+# to lowercase identifier characters.
+TABLE_PREFIX = re.compile(r'^[a-z0-9_]*$')
+
+TRIP_UPDATE_ID_SEQUENCE = 'public.trip_update_id_seq'
+
+_COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r'
+})
+
+class ConnectionPool:
+    """
+    ThreadedConnectionPool shared by the worker threads. Unlike the psycopg2
+    pool, which raises when exhausted, transaction() waits for a free
+    connection.
+    """
+    def __init__(self, postGresConfig, size):
+        self.pool = pool.ThreadedConnectionPool(1, size, **postGresConfig)
+        self.available = BoundedSemaphore(size)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Lends a connection for one transaction: committed if the block
+        succeeds, rolled back if it raises.
+        """
+        self.available.acquire()
+        try:
+            conn = self.pool.getconn()
+            try:
+                with conn:
+                    yield conn
+                Metrics.increment('db_round_trips_total')
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            self.available.release()
+
+    def close(self):
+        self.pool.closeall()
+
+class IdAllocator:
+    """
+    Hands out trip_update IDs reserved from a Postgres sequence in blocks, so
+    concurrent loaders (threads, processes or both scripts) never collide and
+    most feeds need no round trip at all. IDs left in a block when the
+    process exits are simply never used. prepare must be called once before
+    the first feed transaction.
+    """
+    def __init__(self, blockSize, sequence=TRIP_UPDATE_ID_SEQUENCE):
+        self.blockSize = max(1, int(blockSize))
+        self.sequence = sequence
+        self.ids = []
+        self.ready = False
+        self.lock = Lock()
+
+    def prepare(self, conn):
+        """
+        Sets up the sequence and commits, so conn must not be in the middle
+        of a feed or archive transaction.
+        """
+        with self.lock:
+            ensureIdSequence(conn, self.sequence)
+            conn.commit()
+            self.ready = True
+
+    def reserve(self, conn, count):
+        with self.lock:
+            if not self.ready:
+                raise Exception('The trip_update ID sequence is not set up, see IdAllocator.prepare')
+            if count > len(self.ids):
+                needed = max(count - len(self.ids), self.blockSize)
+                with conn.cursor() as cur:
+                    cur.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+                        (self.sequence, needed))
+                    self.ids.extend([row[0] for row in cur.fetchall()])
+                Metrics.increment('db_round_trips_total')
+            reserved = self.ids[:count]
+            del self.ids[:count]
+            return reserved
+
+def ensureIdSequence(conn, sequence=TRIP_UPDATE_ID_SEQUENCE):
+    """
+    Creates the trip_update ID sequence the first time, starting after the
+    IDs already in the table. The advisory lock, held until the caller's
+    transaction ends, keeps two loaders starting at the same time from both
+    seeding it.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (sequence,))
+        cur.execute("SELECT to_regclass(%s)", (sequence,))
+        if cur.fetchone()[0] is None:
+            cur.execute("CREATE SEQUENCE {0}".format(sequence))
+            cur.execute("""
+                SELECT setval(%s, COALESCE(MAX(trip_update_id), 0) + 1, false)
+                FROM {0}
+            """.format(TRIP_UPDATE_TABLE), (sequence,))
+
+def prefixedTable(table, prefix):
+    """Name of a table for a table prefix, the table itself for no prefix."""
+    if not prefix:
+        return table
+    if TABLE_PREFIX.match(prefix) is None:
+        raise Exception('Invalid table prefix {0}'.format(prefix))
+    schema, name = table.split('.')
+    return '{0}.{1}{2}'.format(schema, prefix, name)
+
+def loadRows(cur, table, columns, rows, mode=LOADER_VALUES):
+    """
+    Inserts the row tuples in the table using the configured loader mode.
+    Both modes take the same tuples and store the same values.
+    """
+    # Row tuples reach the arrow loader from the write-behind buffer only
+    if mode in (LOADER_COPY, LOADER_ARROW):
+        copyRows(cur, table, columns, rows)
+        roundTrips = 1
+    elif mode == LOADER_VALUES:
+        query = "INSERT INTO {0} ({1}) VALUES %s".format(table, ", ".join(columns))
+        extras.execute_values(cur, query, rows, page_size=VALUES_PAGE_SIZE)
+        roundTrips = math.ceil(len(rows) / VALUES_PAGE_SIZE)
+    else:
+        raise Exception('Unknown loader mode {0}'.format(mode))
+    Metrics.increment('rows_inserted_total', len(rows), table=table)
+    Metrics.increment('db_round_trips_total', roundTrips)
+
+def upsertRows(cur, table, columns, keyColumns, rows):
+    """
+    Inserts the rows, or replaces the row with the same key when its
+    created_at is older. A key must appear only once in rows.
+    """
+    if not rows:
+        return
+    updates = ", ".join("{0} = EXCLUDED.{0}".format(column)
+        for column in columns if column not in keyColumns)
+    query = """
+        INSERT INTO {0} AS current ({1}) VALUES %s
+        ON CONFLICT ({2}) DO UPDATE SET {3}
+        WHERE current.created_at IS NULL OR EXCLUDED.created_at > current.created_at
+    """.format(table, ", ".join(columns), ", ".join(keyColumns), updates)
+    extras.execute_values(cur, query, rows, page_size=VALUES_PAGE_SIZE)
+    Metrics.increment('rows_upserted_total', len(rows), table=table)
+    Metrics.increment('db_round_trips_total', math.ceil(len(rows) / VALUES_PAGE_SIZE))
+
+def copyRows(cur, table, columns, rows):
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write("\t".join([copyValue(value) for value in row]))
+        buffer.write("\n")
+    buffer.seek(0)
+    query = "COPY {0} ({1}) FROM STDIN".format(table, ", ".join(columns))
+    cur.copy_expert(query, buffer)
+
+def copyCsv(cur, table, columns, buffer, rowCount):
+    """Streams rows already formatted as CSV, e.g. by Columnar, through COPY."""
+    query = "COPY {0} ({1}) FROM STDIN WITH (FORMAT csv)".format(table, ", ".join(columns))
+    cur.copy_expert(query, buffer)
+    Metrics.increment('rows_inserted_total', rowCount, table=table)
+    Metrics.increment('db_round_trips_total')
+
+def copyValue(value):
+    # Text format of COPY: \N is NULL, and backslashes, tabs and newlines
+    # inside values must be escaped.
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, str):
+        return value.translate(_COPY_ESCAPES)
+    return str(value)
@@ -0,0 +1,115 @@
+from collections import OrderedDict
+from threading import Lock
+import hashlib
+import Ingestion
+
+CONFIG_SECTION_DEDUP = 'dedup'
+DEDUP_DEFAULTS = {
+    # Skip snapshots whose header timestamp or content was already ingested
+    'snapshots': True,
+    'snapshotcachesize': 256,
+    # Skip trip updates whose timestamp and content did not change since the
+    # last time they were ingested
+    'trips': True,
+    'tripcachesize': 20000
+}
+
+def contentHash(content):
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+def createDeduplicators(dedupConfig):
+    """Snapshot and trip deduplicators, None for the disabled ones."""
+    snapshotDedup = None
+    tripDedup = None
+    if dedupConfig['snapshots']:
+        snapshotDedup = SnapshotDeduplicator(dedupConfig['snapshotcachesize'])
+    if dedupConfig['trips']:
+        tripDedup = TripUpdateDeduplicator(dedupConfig['tripcachesize'])
+    return snapshotDedup, tripDedup
+
+class SnapshotDeduplicator:
+    """
+    Remembers the header timestamps and content hashes of the last snapshots
+    ingested, per feed type.
+    """
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        self.seen = OrderedDict()
+        self.lock = Lock()
+
+    def claim(self, feedType, timestamp, digest):
+        """
+        Remembers a snapshot and returns True, or returns False when it was
+        already claimed. Checking and remembering under the same lock lets
+        only one insert worker through with a snapshot republished twice.
+        """
+        with self.lock:
+            keys = self.keys(feedType, timestamp, digest)
+            if any(key in self.seen for key in keys):
+                return False
+            for key in keys:
+                self.seen[key] = True
+            while len(self.seen) > 2 * self.capacity:
+                self.seen.popitem(last=False)
+            return True
+
+    def forget(self, feedType, timestamp, digest):
+        # For a snapshot whose transaction rolled back, so it is inserted again
+        with self.lock:
+            for key in self.keys(feedType, timestamp, digest):
+                self.seen.pop(key, None)
+
+    def keys(self, feedType, timestamp, digest):
+        # A feed without header timestamp is only compared by content
+        if timestamp:
+            return ((feedType, 'timestamp', timestamp), (feedType, 'hash', digest))
+        return ((feedType, 'hash', digest),)
+
+    def claimFeed(self, name, data, digest):
+        """Same as claim, for a named JSON or FeedMessage feed."""
+        return self.claim(Ingestion.feedTypeOf(name), Ingestion.feedTimestamp(data), digest)
+
+    def forgetFeed(self, name, data, digest):
+        self.forget(Ingestion.feedTypeOf(name), Ingestion.feedTimestamp(data), digest)
+
+class TripUpdateDeduplicator:
+    """
+    LRU cache of the (timestamp, content hash) last ingested for each trip.
+    It holds at least twice the trips of the largest feed seen, so every
+    active trip stays cached whatever the size of the network.
+    """
+    def __init__(self, minCapacity):
+        self.minCapacity = max(1, int(minCapacity))
+        self.capacity = self.minCapacity
+        self.versions = OrderedDict()
+        self.lock = Lock()
+
+    def filter(self, trips):
+        """
+        Takes (key, timestamp, digest, value) tuples and returns the values of
+        the trips that changed, remembering their new version.
+        """
+        changed = []
+        with self.lock:
+            for key, timestamp, digest, value in trips:
+                version = (timestamp, digest)
+                if self.versions.get(key) == version:
+                    self.versions.move_to_end(key)
+                    continue
+                self.versions[key] = version
+                self.versions.move_to_end(key)
+                changed.append(value)
+            while len(self.versions) > self.capacity:
+                self.versions.popitem(last=False)
+        return changed
+
+    def resize(self, tripCount):
+        """Grows the cache to twice the trips of a feed, filtered in batches."""
+        with self.lock:
+            self.capacity = max(self.capacity, 2 * tripCount)
+
+    def clear(self):
+        # After a failed insert, the cache may hold trips that were never
+        # committed; forgetting everything makes the next feed insert them.
+        with self.lock:
+            self.versions.clear()
@@ -1,23 +1,42 @@
-from __future__ import print_function
-from psycopg2 import extras
-from configparser import ConfigParser
 from datetime import datetime
 from datetime import timedelta
-from pathlib import Path
+from datetime import timezone
 from googleapiclient.http import MediaIoBaseDownload
-from googleapiclient.discovery import build
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from queue import Queue
-from threading import Thread
+from googleapiclient.discovery import build_from_document
+from googleapiclient.errors import HttpError
+from httplib2 import HttpLib2Error
+from threading import local
+from threading import Lock
+from concurrent.futures import ProcessPoolExecutor
+from Pipeline import Pipeline
+import httplib2
 import psycopg2
+import Columnar
+import Config
+import DBLoader
+import Dedup
+import Ingestion
+import SnapshotArchive
+import StaticGtfs
+import Retry
+import Ledger
+import Metrics
+import Schema
+import argparse
+import logging
+import multiprocessing
 import pickle
+import sys
+import time
 import os.path
 import io
+import tempfile
+import hashlib
+import socket
 import zipfile
 import json
 
-CONFIG_FILENAME = "database.ini"
+CONFIG_FILENAME = Config.CONFIG_FILENAME
 CONFIG_SECTION_GDRIVE = "googledrive"
 CONFIG_SECTION_POSTGRES = 'postgresql'
 CONFIG_DRIVE_TEAMDRIVEID = 'teamdriveid'
@@ -25,72 +44,280 @@ CONFIG_DRIVE_DATAFOLDERID = 'datafolderid'
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ['https://www.googleapis.com/auth/drive.metadata.readonly',
           'https://www.googleapis.com/auth/drive.readonly']
+# The token is refreshed when it expires within this margin, so it never
+# expires during a run; otherwise it is used as is.
+TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+# The Drive discovery document is kept on disk, so runs build the service
+# without fetching it. It is fetched again once a week.
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+DISCOVERY_CACHE = 'drive.v3.discovery.json'
+DISCOVERY_MAX_AGE = 7 * 24 * 3600
 # This search query enumerates the files in the specified folder {0}
 # that were created after a date {1}
 DRIVE_SEARCH_QUERY = "'{0}' in parents and createdTime > '{1}'"
-DOWNLOAD_PAGE_SIZE = 4
-#MAX_THREADS = 5
+# Files of folder {0} created from {1} (inclusive) up to {2} (exclusive)
+BACKFILL_SEARCH_QUERY = "'{0}' in parents and createdTime >= '{1}' and createdTime < '{2}'"
+DRIVE_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Largest pageSize accepted by files().list
+MAX_LIST_PAGE_SIZE = 1000
+LIST_FIELDS = "nextPageToken, files(id, name, size, md5Checksum, createdTime)"
+PARTIAL_SUFFIX = '.part'
+HASH_BLOCK_SIZE = 1024 * 1024
+RETRYABLE_HTTP_STATUSES = (429, 500, 502, 503, 504)
+RETRYABLE_DRIVE_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+CONFIG_SECTION_RETRY = 'retry'
+CONFIG_SECTION_PIPELINE = 'pipeline'
+# Worker count and input queue size of each pipeline stage
+PIPELINE_DEFAULTS = {
+    # The first listing page is small so downloads start right away, then
+    # page sizes double up to listpagesize.
+    'listfirstpagesize': 100,
+    'listpagesize': MAX_LIST_PAGE_SIZE,
+    'downloadworkers': 4,
+    # Only holds listed file metadata, so listing can run far ahead
+    'downloadqueuesize': 10000,
+    'parseworkers': 2,
+    'parsequeuesize': 4,
+    'insertworkers': 2,
+    'insertqueuesize': 4,
+    # "stream" reads the JSON members straight out of the zip, "extract"
+    # unzips them to files/<name>/ first.
+    'unzipmode': 'stream',
+    # "memory" downloads archives into a buffer that is handed directly to
+    # the zip reader and spills to disk past spillthreshold bytes, "disk"
+    # writes them to files/ first.
+    'downloadmode': 'memory',
+    'spillthreshold': 64 * 1024 * 1024,
+    'chunksize': 10 * 1024 * 1024,
+    # Worker processes of --backfill, 0 for one per core
+    'backfillworkers': 0
+}
+
+_threadLocal = local()
+DiscoveryLock = Lock()
+DiscoveryDocument = None
+log = logging.getLogger(__name__)
 
 def main():
+    parser = argparse.ArgumentParser(
+        description="Downloads the GTFS-RT archives from Google Drive and inserts them in the database.")
+    parser.add_argument('--backfill', nargs=2, metavar=('START', 'END'), type=parseBackfillTime,
+        help="insert the archives created from START up to END (e.g. 2019-01-01 2019-02-01), "
+            "parsing them in one process per core")
+    parser.add_argument('--drop-indexes', action='store_true',
+        help="with --backfill, drop the secondary indexes during the backfill and rebuild them after")
+    args = parser.parse_args()
+
+    global MetricsConfig
+    MetricsConfig = Config.readConfig(Metrics.CONFIG_SECTION_METRICS, CONFIG_FILENAME,
+        Metrics.METRICS_DEFAULTS)
+    Metrics.start(MetricsConfig)
     global GoogleDriveConfig
-    GoogleDriveConfig = readConfig(CONFIG_SECTION_GDRIVE, CONFIG_FILENAME)
+    GoogleDriveConfig = Config.readConfig(CONFIG_SECTION_GDRIVE, CONFIG_FILENAME)
     global PostGresConfig
-    PostGresConfig = readConfig(CONFIG_SECTION_POSTGRES, CONFIG_FILENAME)
+    PostGresConfig = Config.readConfig(CONFIG_SECTION_POSTGRES, CONFIG_FILENAME)
+    global LoaderConfig
+    LoaderConfig = Config.readConfig(DBLoader.CONFIG_SECTION_LOADER, CONFIG_FILENAME,
+        DBLoader.LOADER_DEFAULTS)
+    global TripUpdateIds
+    TripUpdateIds = DBLoader.IdAllocator(LoaderConfig['idblocksize'])
+    global ParquetConfig, ParquetExport
+    ParquetConfig = Config.readConfig(Columnar.CONFIG_SECTION_PARQUET, CONFIG_FILENAME,
+        Columnar.PARQUET_DEFAULTS)
+    ParquetExport = Columnar.createExport(ParquetConfig)
+    global GtfsConfig, StaticFeed
+    GtfsConfig = Config.readConfig(StaticGtfs.CONFIG_SECTION_GTFS, CONFIG_FILENAME, StaticGtfs.GTFS_DEFAULTS)
+    # Builds the index if needed, before the backfill processes open it
+    StaticFeed = StaticGtfs.load(GtfsConfig)
+    global DedupConfig
+    DedupConfig = Config.readConfig(Dedup.CONFIG_SECTION_DEDUP, CONFIG_FILENAME, Dedup.DEDUP_DEFAULTS)
+    global SnapshotDedup, TripDedup
+    SnapshotDedup, TripDedup = Dedup.createDeduplicators(DedupConfig)
+    global PipelineConfig
+    PipelineConfig = Config.readConfig(CONFIG_SECTION_PIPELINE, CONFIG_FILENAME, PIPELINE_DEFAULTS)
+    global RetryConfig
+    RetryConfig = Config.readConfig(CONFIG_SECTION_RETRY, CONFIG_FILENAME, Retry.RETRY_DEFAULTS)
+    global SchemaConfig
+    SchemaConfig = Config.readConfig(Schema.CONFIG_SECTION_SCHEMA, CONFIG_FILENAME, Schema.SCHEMA_DEFAULTS)
 
-    service = setupDriveCredentials()
+    setupDriveCredentials()
     if not os.path.exists("files"):
         os.makedirs("files")
     
+    global DriveLedger, LedgerConfig
+    LedgerConfig = Config.readConfig(Ledger.CONFIG_SECTION_LEDGER, CONFIG_FILENAME, Ledger.LEDGER_DEFAULTS)
+    DriveLedger = Ledger.Ledger(LedgerConfig['path'])
+
+    if args.backfill is not None:
+        pipeline, success = runBackfill(args.backfill[0], args.backfill[1], args.drop_indexes)
+    else:
+        pipeline, success = runIncremental(LedgerConfig['overlapminutes'])
+        if success:
+            DriveLedger.commitWatermark()
+    DriveLedger.close()
+    Metrics.reportSummary(MetricsConfig['summary'])
+    if not success:
+        for stage, error in pipeline.errors:
+            log.error("Stage %s failed: %s", stage, error)
+        sys.exit(1)
+    log.info("Job's done.")
+
+def runIncremental(overlapMinutes):
+    global DBPool
+    DBPool = DBLoader.ConnectionPool(PostGresConfig, LoaderConfig['poolsize'])
+    with DBPool.transaction() as conn:
+        Schema.ensureFuturePartitions(conn, SchemaConfig['partitionsahead'])
+        Schema.addColumns(conn)
+        if LoaderConfig['latest']:
+            Schema.createLatestTables(conn)
+    # On a connection of its own, since it commits
+    with DBPool.transaction() as conn:
+        TripUpdateIds.prepare(conn)
+
     # Building the GDrive query parameter first because
     # it needs to be the exact same between paged queries.
-    dateNow = datetime.now() - timedelta(days=1)
-    tzNow = dateNow.astimezone().isoformat(timespec='seconds')
-    query = DRIVE_SEARCH_QUERY.format(GoogleDriveConfig[CONFIG_DRIVE_DATAFOLDERID], tzNow)
+    query = DRIVE_SEARCH_QUERY.format(GoogleDriveConfig[CONFIG_DRIVE_DATAFOLDERID],
+        getQueryStart(DriveLedger.getWatermark(), overlapMinutes))
 
-    filesLeft = True
-    nextPageToken = None
-    #q = Queue()
-    while (filesLeft):
-        result = getFilesFromGDrive(query, service, nextPageToken)
-        nextPageToken = result[0]
-        if (nextPageToken is None):
-            filesLeft = False
-        zips = result[1]
-        
-    ### Single-thread solution
-        for zip in zips:
-            processZip(zip)
-        
-    ### Multithreaded solution
-        #for zip in zips:
-        #    q.put(zip)
-        #for i in range(MAX_THREADS):
-        #   worker = Thread(target=doWork, args=(q,))
-        #   worker.daemon = True
-        #   worker.start()
-    #q.join()
-    print("Job's done.")
-
-### Worker function
-#def doWork(q):
-#  while True:
-#      zip = q.get()
-#      processZip(zip)
-#      q.task_done()
-
-def readConfig(section, filename=CONFIG_FILENAME):
-    parser = ConfigParser()
-    parser.read(filename)
-    sectionParams = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            sectionParams[param[0]] = param[1]
-    else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
-    return sectionParams
+    # Listing -> downloading -> unzip+parse -> DB insert, each stage with its
+    # own workers and bounded queue so downloads of the next page overlap with
+    # inserts of the previous one without holding every archive in memory.
+    pipeline = Pipeline()
+    pipeline.addStage("list", listFiles, 1)
+    pipeline.addStage("download", downloadStage,
+        PipelineConfig['downloadworkers'], PipelineConfig['downloadqueuesize'])
+    pipeline.addStage("parse", parseZip,
+        PipelineConfig['parseworkers'], PipelineConfig['parsequeuesize'])
+    pipeline.addStage("insert", insertStage,
+        PipelineConfig['insertworkers'], PipelineConfig['insertqueuesize'])
+    success = pipeline.run([query])
+    DBPool.close()
+    return pipeline, success
+
+def runBackfill(start, end, dropIndexes=False):
+    # Parsing and building rows is pure Python, so threads would all wait on
+    # the GIL. Archives are listed in createdTime order and downloaded to
+    # files/ here, then each one is handed by path to a worker process that
+    # parses and inserts it through its own connection. Archives already in
+    # the ledger are skipped, so an interrupted backfill resumes where it
+    # stopped; the watermark of the regular runs is left alone.
+    query = BACKFILL_SEARCH_QUERY.format(GoogleDriveConfig[CONFIG_DRIVE_DATAFOLDERID], start, end)
+    workers = PipelineConfig['backfillworkers'] or os.cpu_count() or 1
+    PipelineConfig['downloadmode'] = 'disk'
+    log.info("Backfilling %s to %s with %d processes", start, end, workers)
+    conn = psycopg2.connect(**PostGresConfig)
+    try:
+        Schema.ensurePartitions(conn, toUtc(start), toUtc(end))
+        Schema.addColumns(conn)
+        if LoaderConfig['latest']:
+            Schema.createLatestTables(conn)
+        if dropIndexes:
+            Schema.dropIndexes(conn)
+    finally:
+        conn.close()
+    # Forking this process would copy the pipeline threads' locks and the
+    # ledger connection, so the workers start from a fresh interpreter.
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+            initializer=initBackfillWorker,
+            initargs=(PostGresConfig, LoaderConfig, PipelineConfig, DedupConfig, ParquetConfig,
+                GtfsConfig, LedgerConfig['path'],
+                MetricsConfig['loglevel'])) as executor:
+        pipeline = Pipeline()
+        pipeline.addStage("list", listFiles, 1)
+        pipeline.addStage("download", downloadStage,
+            PipelineConfig['downloadworkers'], PipelineConfig['downloadqueuesize'])
+        # One thread per process waits on its archive, so no more archives
+        # than processes are downloaded but not yet inserted past the queue.
+        pipeline.addStage("backfill", lambda archive: backfillStage(executor, archive),
+            workers, workers)
+        success = pipeline.run([query])
+    if dropIndexes:
+        if success:
+            conn = psycopg2.connect(**PostGresConfig)
+            try:
+                Schema.createIndexes(conn)
+            finally:
+                conn.close()
+        else:
+            # Rebuilding takes long and the backfill will be run again
+            log.warning("The secondary indexes are still dropped, rebuild them with "
+                "python Schema.py create-indexes")
+    return pipeline, success
+
+def parseBackfillTime(value):
+    # Dates without a time zone are taken as UTC, like Drive's createdTime
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date: {0}".format(value))
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return date.isoformat(timespec='seconds')
+
+def toUtc(value):
+    # created_at is stored as a UTC timestamp without time zone
+    return datetime.fromisoformat(value).astimezone(timezone.utc).replace(tzinfo=None)
+
+def backfillStage(executor, archive):
+    # The process records the archive and its members in the ledger itself
+    stats = executor.submit(backfillArchive, archive.source, archive.item).result()
+    Metrics.REGISTRY.merge(stats['metrics'])
+    log.info("%s: %d feeds inserted, %d skipped, %d bytes in %.1fs (process %d)",
+        stats['archive'], stats['inserted'], stats['skipped'], stats['bytes'],
+        stats['seconds'], stats['pid'])
+
+def initBackfillWorker(postGresConfig, loaderConfig, pipelineConfig, dedupConfig, parquetConfig,
+                       gtfsConfig, ledgerPath, logLevel):
+    # Runs once in each backfill process
+    Metrics.setupLogging(logLevel)
+    global LoaderConfig, PipelineConfig, DBPool, TripUpdateIds, SnapshotDedup, TripDedup
+    global ParquetExport, StaticFeed, DriveLedger
+    LoaderConfig = loaderConfig
+    PipelineConfig = pipelineConfig
+    DBPool = DBLoader.ConnectionPool(postGresConfig, 1)
+    TripUpdateIds = DBLoader.IdAllocator(LoaderConfig['idblocksize'])
+    # Before the first archive transaction, since it commits
+    with DBPool.transaction() as conn:
+        TripUpdateIds.prepare(conn)
+    SnapshotDedup, TripDedup = Dedup.createDeduplicators(dedupConfig)
+    ParquetExport = Columnar.createExport(parquetConfig)
+    # Maps the index built by the main process
+    StaticFeed = StaticGtfs.load(gtfsConfig)
+    DriveLedger = Ledger.Ledger(ledgerPath)
+
+def backfillArchive(path, item):
+    """
+    Parses and inserts a downloaded archive in a backfill process, deletes it
+    and records it in the ledger once inserted, and returns its stats.
+    """
+    stats = {'archive': item['name'], 'bytes': os.path.getsize(path), 'inserted': 0,
+        'skipped': 0, 'pid': os.getpid()}
+    started = time.time()
+    try:
+        for batch in parseZip(Archive(item['name'], path, item)):
+            insertStage(batch, stats)
+    except Exception:
+        # Trips remembered from the failed transaction were never committed
+        if TripDedup is not None:
+            TripDedup.clear()
+        raise
+    stats['seconds'] = time.time() - started
+    # Sent back with the stats, so the main process reports them too
+    stats['metrics'] = Metrics.REGISTRY.takeState()
+    return stats
+
+def getQueryStart(watermark, overlapMinutes):
+    # Resume from the createdTime of the last complete run, or look back one
+    # day on the very first run.
+    if watermark is None:
+        dateStart = datetime.now() - timedelta(days=1)
+        return dateStart.astimezone().isoformat(timespec='seconds')
+    dateStart = datetime.strptime(watermark[:19], DRIVE_TIME_FORMAT)
+    dateStart = dateStart.replace(tzinfo=timezone.utc) - timedelta(minutes=overlapMinutes)
+    return dateStart.isoformat(timespec='seconds')
 
 def setupDriveCredentials():
+    global DriveCredentials
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -99,219 +326,415 @@ def setupDriveCredentials():
         with open('token.pickle', 'rb') as token:
             creds = pickle.load(token)
     # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server()
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
-    service = build('drive', 'v3', credentials=creds)
-    return service
-
-def getFilesFromGDrive(query, service, nextPageToken=None):
+    # The auth libraries are slow to import and only needed here, so most
+    # runs never load them.
+    if creds and creds.refresh_token and isExpiring(creds):
+        from google.auth.transport.requests import Request
+        creds.refresh(Request())
+        saveCredentials(creds)
+    elif not creds or not creds.valid:
+        from google_auth_oauthlib.flow import InstalledAppFlow
+        flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+        creds = flow.run_local_server()
+        saveCredentials(creds)
+    DriveCredentials = creds
+    return getDriveService()
+
+def isExpiring(creds):
+    if creds.expiry is None:
+        return not creds.valid
+    return datetime.utcnow() >= creds.expiry - TOKEN_REFRESH_MARGIN
+
+def saveCredentials(creds):
+    # Saved for the next run
+    with open('token.pickle', 'wb') as token:
+        pickle.dump(creds, token)
+
+def getDriveService():
+    # The Drive service wraps an httplib2 connection, which is not thread-safe,
+    # so every worker thread builds its own, from the same discovery document.
+    if getattr(_threadLocal, 'service', None) is None:
+        _threadLocal.service = build_from_document(getDiscoveryDocument(),
+            credentials=DriveCredentials)
+    return _threadLocal.service
+
+def getDiscoveryDocument():
+    global DiscoveryDocument
+    with DiscoveryLock:
+        if DiscoveryDocument is None:
+            DiscoveryDocument = loadDiscoveryDocument(DISCOVERY_CACHE)
+    return DiscoveryDocument
+
+def loadDiscoveryDocument(path):
+    """
+    Reads the cached discovery document, fetching it first when it is missing
+    or older than DISCOVERY_MAX_AGE. A stale copy is used if the fetch fails.
+    """
+    if not os.path.exists(path) or time.time() - os.path.getmtime(path) > DISCOVERY_MAX_AGE:
+        try:
+            content = callDriveWithRetries(fetchDiscoveryDocument)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(content)
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            if not os.path.exists(path):
+                raise
+            log.warning("Using the cached Drive discovery document, could not fetch it: %s", e)
+    with open(path, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def fetchDiscoveryDocument():
+    response, content = httplib2.Http(timeout=60).request(DISCOVERY_URL)
+    if response.status != 200:
+        error = HttpLib2Error if response.status in RETRYABLE_HTTP_STATUSES else Exception
+        raise error('Fetching {0} returned {1}'.format(DISCOVERY_URL, response.status))
+    # Only a valid document replaces the cached one
+    json.loads(content.decode('utf-8'))
+    return content
+
+def listFiles(query):
+    nextPageToken = None
+    filesLeft = True
+    maxPageSize = min(PipelineConfig['listpagesize'], MAX_LIST_PAGE_SIZE)
+    pageSize = min(PipelineConfig['listfirstpagesize'], maxPageSize)
+    while (filesLeft):
+        result = callDriveWithRetries(lambda: getFilesFromGDrive(
+            query, getDriveService(), nextPageToken, pageSize))
+        pageSize = min(pageSize * 2, maxPageSize)
+        nextPageToken = result[0]
+        if (nextPageToken is None):
+            filesLeft = False
+        for item in result[1]:
+            DriveLedger.seen(item['createdTime'])
+            if DriveLedger.isProcessed(item['id']):
+                log.info(u'Skipping %s (%s), already processed', item['id'], item['name'])
+                continue
+            yield item
+
+def getFilesFromGDrive(query, service, nextPageToken=None, pageSize=MAX_LIST_PAGE_SIZE):
     # Call the Drive v3 API
     results = service.files().list(
         includeTeamDriveItems=True, supportsTeamDrives=True, pageToken=nextPageToken,
         corpora="teamDrive",teamDriveId=GoogleDriveConfig[CONFIG_DRIVE_TEAMDRIVEID], 
-        q=query, pageSize=DOWNLOAD_PAGE_SIZE, orderBy='createdTime',
-        fields="nextPageToken, files(id, name)").execute()
+        q=query, pageSize=pageSize, orderBy='createdTime',
+        fields=LIST_FIELDS).execute()
     pToken = results.get('nextPageToken', None)
     items = results.get('files', [])
-    fileList = []
     if not items:
-        print('No files found.')
-    else:
-        for item in items:
-            fileList.append(downloadFile(service, item['id'], item['name'].replace(":", "-")))
-    return (pToken, fileList)
+        log.info('No files found.')
+    return (pToken, items)
 
-def downloadFile(service, fileId, fileName):
+def downloadStage(item):
+    fileName = item['name'].replace(":", "-")
+    # Chunks are retried on their own; a corrupt archive is downloaded again
+    # from scratch.
+    source = callDriveWithRetries(lambda: downloadArchive(item, fileName),
+        lambda e: isinstance(e, ChecksumError))
+    yield Archive(fileName, source, item)
+
+def downloadArchive(item, fileName):
+    size = int(item['size']) if 'size' in item else None
+    if PipelineConfig['downloadmode'] == 'memory':
+        return downloadToBuffer(getDriveService(), item['id'], fileName,
+            item.get('md5Checksum'))
+    return downloadFile(getDriveService(), item['id'], fileName,
+        item.get('md5Checksum'), size)
+
+def downloadFile(service, fileId, fileName, md5Checksum=None, size=None):
+    # The archive is written to a .part file first. If a previous run was
+    # interrupted, the download resumes after the bytes already in it.
     filePath = os.path.join(os.getcwd(), "files", fileName)
-    print(u'Downloading: {0} ({1})'.format(fileId, fileName))
-    fh = None
-    request = service.files().get_media(fileId=fileId)
-    with io.FileIO(filePath, 'w+b') as fh:
-        downloader = MediaIoBaseDownload(fh, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            print("Download %d%%" % int(status.progress() * 100))
+    partPath = filePath + PARTIAL_SUFFIX
+    md5 = hashlib.md5()
+    offset = 0
+    if os.path.exists(partPath):
+        offset = hashFile(partPath, md5)
+        log.info(u'Resuming: %s (%s) at byte %d', fileId, fileName, offset)
+    else:
+        log.info(u'Downloading: %s (%s)', fileId, fileName)
+    try:
+        with io.FileIO(partPath, 'ab') as fh, Metrics.timed('download'):
+            if size is None or offset < size:
+                request = service.files().get_media(fileId=fileId)
+                downloadInto(fh, request, md5, offset)
+        verifyChecksum(fileName, md5, md5Checksum)
+    except ChecksumError:
+        os.remove(partPath)
+        raise
+    os.replace(partPath, filePath)
     return filePath
 
-def processZip(zip):
-    folder = unzip(zip)
-    os.remove(zip)
-    filesList = os.listdir(folder)
-    for file in filesList:
-        data = parseJson(os.path.join(folder, file))
-        if "tripupdates" in file:
-            success = insertTripUpdatesInDB(data)
-            if (success): print("Inserted " + file + " successfully in database.")
-        elif "vehiclepositions" in file:
-            success = insertVehiclePositionsInDB(data)
-            if (success): print("Inserted " + file + " successfully in database.")
-        os.remove(os.path.join(folder, file))
-        if len(os.listdir(folder)) == 0:
-            os.rmdir(folder)
-    print('')
+def downloadToBuffer(service, fileId, fileName, md5Checksum=None):
+    # Small archives stay in memory and go straight to the zip reader, larger
+    # ones spill to a temporary file under files/ once past the threshold.
+    log.info(u'Downloading: %s (%s) in memory', fileId, fileName)
+    request = service.files().get_media(fileId=fileId)
+    buffer = tempfile.SpooledTemporaryFile(
+        max_size=PipelineConfig['spillthreshold'], dir="files")
+    try:
+        md5 = hashlib.md5()
+        with Metrics.timed('download'):
+            downloadInto(buffer, request, md5)
+        verifyChecksum(fileName, md5, md5Checksum)
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
 
-def unzip(file):
-    fileName = os.path.basename(file) # Gets the file name
-    fileName = os.path.splitext(fileName)[0] # Removes the file extension
-    with zipfile.ZipFile(file, 'r') as zip_ref:
-        zip_ref.extractall(os.path.join("files", fileName))
-    return os.path.join("files", fileName)
+def downloadInto(fh, request, md5, offset=0):
+    downloader = MediaIoBaseDownload(HashingWriter(fh, md5), request,
+        chunksize=PipelineConfig['chunksize'])
+    # MediaIoBaseDownload has no public way to start past the first byte
+    downloader._progress = offset
+    done = False
+    while done is False:
+        # A failed chunk leaves the downloader where it was, so retrying
+        # next_chunk resumes at the same offset.
+        status, done = callDriveWithRetries(downloader.next_chunk)
+        log.debug("Download %d%%", int(status.progress() * 100))
+
+class HashingWriter:
+    """
+    File wrapper given to MediaIoBaseDownload, hashing the chunks as they are
+    written so the archive does not need to be read back to be verified.
+    """
+    def __init__(self, fh, md5):
+        self.fh = fh
+        self.md5 = md5
+
+    def write(self, data):
+        Metrics.increment('bytes_downloaded_total', len(data))
+        self.md5.update(data)
+        return self.fh.write(data)
 
-def parseJson(file):
-    print("Parsing {0}".format(os.path.basename(file)))
-    data = None
-    with open(file) as j:
-        data = json.load(j)
-    return data
+class ChecksumError(Exception):
+    pass
 
-def insertTripUpdatesInDB(jsonData):
-    if "entity" not in jsonData:
+def hashFile(path, md5):
+    size = 0
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            md5.update(block)
+            size += len(block)
+    return size
+
+def verifyChecksum(fileName, md5, md5Checksum):
+    if md5Checksum is not None and md5.hexdigest() != md5Checksum:
+        raise ChecksumError('Checksum mismatch for {0}: expected {1}, got {2}'.format(
+            fileName, md5Checksum, md5.hexdigest()))
+
+def callDriveWithRetries(func, isRetryable=None):
+    return Retry.callWithRetries(func, isRetryable or isRetryableDriveError,
+        RetryConfig['retries'], RetryConfig['retrybasedelay'], RetryConfig['retrymaxdelay'])
+
+def isRetryableDriveError(e):
+    # Server errors, rate limits and quota errors are worth waiting for,
+    # anything else (not found, no access...) is not.
+    if isinstance(e, HttpError):
+        if e.resp.status in RETRYABLE_HTTP_STATUSES:
+            return True
+        if e.resp.status == 403:
+            try:
+                reasons = [error.get('reason') for error in
+                    json.loads(e.content.decode('utf-8'))['error']['errors']]
+            except (ValueError, KeyError, TypeError):
+                return False
+            return any(reason in RETRYABLE_DRIVE_REASONS for reason in reasons)
         return False
-    conn = None
-    # Get the last trip_update ID in the DB
-    queryGetLastId = """
-        SELECT MAX(trip_update_id) FROM public.trip_update
-    """
-    lastId = 0
-    with psycopg2.connect(**PostGresConfig) as conn:
-        with conn.cursor() as cur:
-            cur.execute(queryGetLastId)
-            lastId = cur.fetchone()[0]
-    if lastId is None:
-        lastId = 0
-    
-    # Insertion queries
-    queryTripUpdate = """
-        INSERT INTO public.trip_update
-            (trip_update_id,
-            trip_id,
-            start_time,
-            route_id,
-            created_at)
-        VALUES %s
+    return isinstance(e, (ConnectionError, socket.timeout, HttpLib2Error))
+
+class Archive:
     """
-    queryStopTimeUpdate = """
-        INSERT INTO public.stop_time_update
-            (stop_id, 
-            stop_sequence, 
-            trip_update_id, 
-            departure_time, 
-            arrival_time, 
-            schedule_relationship,
-            created_at)
-        VALUES %s
+    A downloaded zip whose feeds are being inserted. The source is either the
+    path of the zip under files/ or an in-memory buffer. It is only deleted,
+    and recorded in the ledger, once every batch of its feeds has been
+    committed, so a failed run picks the file up again. The members of each
+    committed batch are recorded as well, and skipped by that next run.
     """
+    def __init__(self, name, source, item=None):
+        self.name = name
+        self.source = source
+        self.item = item
+        self.pending = 0
+        self.lock = Lock()
+
+    def setPending(self, pending):
+        self.pending = pending
+        if pending == 0:
+            self.finish()
+
+    def batchDone(self):
+        with self.lock:
+            self.pending -= 1
+            done = self.pending == 0
+        if done:
+            self.finish()
+
+    def processedMembers(self):
+        if self.item is None:
+            return set()
+        done = DriveLedger.processedMembers(self.item['id'])
+        if done:
+            log.info("%s: resuming after %d feeds already inserted", self.name, len(done))
+        return done
+
+    def membersDone(self, members):
+        if self.item is not None:
+            DriveLedger.markMembersProcessed(self.item['id'], members)
 
-    # JSON parsing
-    paramsTripUpdate = []
-    paramsStopUpdate = []
-    for en in jsonData["entity"]:
-        tripUp = en['tripUpdate']
-        if tripUp["stopTimeUpdate"][0]['scheduleRelationship'] == 'NO_DATA':
-            #print('Skipping trip ' + tripUp['trip']['tripId'] + " because no StopTimeUpdate data was found.")
-            continue
-        lastId += 1
-        timestamp = None
-        if 'timestamp' in tripUp:
-            timestamp = datetime.utcfromtimestamp(int(tripUp['timestamp']))
+    def finish(self):
+        self.cleanup()
+        if self.item is not None:
+            DriveLedger.markProcessed(self.item['id'], self.item['name'], self.item['createdTime'])
+
+    def cleanup(self):
+        if isinstance(self.source, str):
+            if os.path.exists(self.source):
+                os.remove(self.source)
         else:
-            timestamp = None
-        tripUpdate = (
-            lastId,
-            tripUp['trip']['tripId'],
-            tripUp['trip']['startDate'] + ' ' + tripUp['trip']['startTime'],
-            tripUp['trip']['routeId'],
-            timestamp
-        )
-        paramsTripUpdate.append(tripUpdate)
-        for stopTimeUpdate in tripUp["stopTimeUpdate"]:
-            departureTime = None
-            arrivalTime = None
-            if 'departure' in stopTimeUpdate:
-                departureTime = datetime.utcfromtimestamp(int(stopTimeUpdate['departure']['time']))
-            else:
-                departureTime = None
-            if 'arrival' in stopTimeUpdate:
-                arrivalTime = datetime.utcfromtimestamp(int(stopTimeUpdate['arrival']['time']))
+            self.source.close()
+
+def parseZip(archive):
+    if archive.name.endswith(SnapshotArchive.SNAPSHOT_EXTENSION):
+        return readSnapshotArchive(archive)
+    if PipelineConfig['unzipmode'] == 'extract':
+        return extractZip(archive)
+    return streamZip(archive)
+
+def streamZip(archive):
+    # Yields (archive, feeds) batches for the insert stage: one batch per
+    # member, or a single batch holding every member when the whole archive
+    # is loaded in one transaction.
+    wholeArchive = LoaderConfig['transaction'] == DBLoader.TRANSACTION_ARCHIVE
+    done = archive.processedMembers()
+    with zipfile.ZipFile(archive.source, 'r') as zip_ref:
+        members = [m for m in zip_ref.namelist()
+            if isFeedFile(m) and os.path.basename(m) not in done]
+        archive.setPending(1 if wholeArchive and members else len(members))
+        feeds = []
+        for member in members:
+            file = os.path.basename(member)
+            with Metrics.timed('unzip'):
+                content = zip_ref.read(member)
+            feed = (file, parseJson(file, content), Dedup.contentHash(content))
+            if wholeArchive:
+                feeds.append(feed)
             else:
-                arrivalTime = None
-            stopUpdate = (
-                stopTimeUpdate['stopId'],
-                stopTimeUpdate['stopSequence'],
-                lastId,
-                departureTime,
-                arrivalTime,
-                stopTimeUpdate['scheduleRelationship'],
-                timestamp
-                #TODO stop_time_id
-            )
-            paramsStopUpdate.append(stopUpdate)
-            
-    # Bulk insertion in database
-    with psycopg2.connect(**PostGresConfig) as conn:
-        
-        with conn.cursor() as cur:
-            #cur.execute(queryTripUpdate, paramsTripUpdate)
-            #tripUpdateId = cur.fetchone()[0] # Fetch the ID that is returned by the DB
-            #cur.execute(queryStopTimeUpdate, paramsStopUpdate)
-            print('Inserting TripUpdate...')
-            psycopg2.extras.execute_values(cur, queryTripUpdate, paramsTripUpdate, page_size=200)
-            print('Inserting StopTimeUpdate...')
-            psycopg2.extras.execute_values(cur, queryStopTimeUpdate, paramsStopUpdate, page_size=200)
-            return True
-    return False
+                yield (archive, [feed])
+        if feeds:
+            yield (archive, feeds)
 
-def insertVehiclePositionsInDB(jsonData):
-    if "entity" not in jsonData:
-        return False
-    conn = None
-    #queryVehicle = """
-    #    INSERT INTO public.vehicle
-    #        (vehicle_id)
-    #    VALUES %s
-    #    ON CONFLICT DO NOTHING
-    #"""
-    queryVehiclePositions = """
-        INSERT INTO public.vehicle_position
-            (vehicle_id, 
-            trip_id, 
-            current_stop_sequence, 
-            current_status, 
-            vehicle_lat, 
-            vehicle_lon, 
-            created_at)
-        VALUES %s
-    """
-    with psycopg2.connect(**PostGresConfig) as conn:
-        paramsVehicle = []
-        data_list = []
-        for en in jsonData["entity"]: 
-            vehicle = en['vehicle']
-            paramsVehicle.append(vehicle['vehicle']['id'])
-            data = (
-                vehicle['vehicle']['id'],
-                vehicle['trip']['tripId'],
-                vehicle['currentStopSequence'], 
-                vehicle['currentStatus'], 
-                vehicle['position']['latitude'], 
-                vehicle['position']['longitude'], 
-                datetime.utcfromtimestamp(int(vehicle['timestamp']))
-            )
-            data_list.append(data)
-        with conn.cursor() as cur:
-            #psycopg2.extras.execute_values(cur, queryVehicle, paramsVehicle, page_size=200)
-            print('Inserting VehiclePositions...')
-            psycopg2.extras.execute_values(cur, queryVehiclePositions, data_list, page_size=200)
-            return True
-    return False
+def extractZip(archive):
+    folder = unzip(archive.source, archive.name)
+    done = archive.processedMembers()
+    for file in done.intersection(os.listdir(folder)):
+        os.remove(os.path.join(folder, file))
+    filesList = os.listdir(folder)
+    if not filesList:
+        os.rmdir(folder)
+    wholeArchive = LoaderConfig['transaction'] == DBLoader.TRANSACTION_ARCHIVE
+    archive.setPending(1 if wholeArchive and filesList else len(filesList))
+    feeds = []
+    for file in filesList:
+        with open(os.path.join(folder, file), 'rb') as j:
+            content = j.read()
+        os.remove(os.path.join(folder, file))
+        if len(os.listdir(folder)) == 0:
+            os.rmdir(folder)
+        feeds.append((file, parseJson(file, content), Dedup.contentHash(content)))
+        if not wholeArchive:
+            yield (archive, feeds)
+            feeds = []
+    if feeds:
+        yield (archive, feeds)
+
+def readSnapshotArchive(archive):
+    # Snapshot archives are memory-mapped when on disk, and each snapshot is
+    # only decompressed when its turn comes.
+    source = archive.source if isinstance(archive.source, str) else archive.source.read()
+    reader = SnapshotArchive.SnapshotReader(source)
+    try:
+        wholeArchive = LoaderConfig['transaction'] == DBLoader.TRANSACTION_ARCHIVE
+        done = archive.processedMembers()
+        entries = [entry for entry in reader.entries
+            if SnapshotArchive.snapshotName(entry) not in done]
+        archive.setPending(1 if wholeArchive and entries else len(entries))
+        feeds = []
+        for entry in entries:
+            with Metrics.timed('unzip'):
+                content = reader.read(entry)
+            file = SnapshotArchive.snapshotName(entry)
+            log.debug("Parsing %s", file)
+            with Metrics.timed('parse'):
+                feed = Ingestion.parseFeed(content)
+            feeds.append((file, feed, Dedup.contentHash(content)))
+            if not wholeArchive:
+                yield (archive, feeds)
+                feeds = []
+        if feeds:
+            yield (archive, feeds)
+    finally:
+        reader.close()
+
+def isFeedFile(file):
+    return "tripupdates" in file or "vehiclepositions" in file
+
+def insertStage(batch, stats=None):
+    archive, feeds = batch
+    inserted = []
+    skipped = 0
+    claimed = []
+    latest = Ingestion.LatestRows() if LoaderConfig['latest'] else None
+    try:
+        with DBPool.transaction() as conn:
+            for file, data, digest in feeds:
+                if SnapshotDedup is not None:
+                    # Claimed before the insert, so another insert worker
+                    # skips the same snapshot republished in its archive
+                    if not SnapshotDedup.claimFeed(file, data, digest):
+                        log.info("Skipping %s, already inserted.", file)
+                        Metrics.increment('feeds_skipped_total')
+                        skipped += 1
+                        continue
+                    claimed.append((file, data, digest))
+                if (insertFeed(file, data, conn, latest)): inserted.append(file)
+            if latest is not None:
+                latest.upsert(conn)
+    except Exception:
+        # Rolled back, so the snapshots are inserted again with the archive
+        for file, data, digest in claimed:
+            SnapshotDedup.forgetFeed(file, data, digest)
+        raise
+    archive.membersDone([file for file, data, digest in feeds])
+    for file in inserted:
+        log.info("Inserted %s successfully in database.", file)
+    if stats is not None:
+        stats['inserted'] += len(inserted)
+        stats['skipped'] += skipped
+    archive.batchDone()
+
+def insertFeed(file, data, conn, latest=None):
+    # data is either a JsonFeed or, from snapshot archives, a FeedMessage
+    if Columnar.isUsed(LoaderConfig['mode'], ParquetExport):
+        return Columnar.insertFeed(file, data, conn, TripUpdateIds, TripDedup,
+            LoaderConfig['batchsize'], latest, ParquetExport, StaticFeed)
+    return Ingestion.insertFeed(file, data, conn, TripUpdateIds, LoaderConfig['mode'],
+        TripDedup, LoaderConfig['batchsize'], latest, StaticFeed)
+
+def unzip(file, fileName=None):
+    if fileName is None:
+        fileName = os.path.basename(file) # Gets the file name
+    fileName = os.path.splitext(fileName)[0] # Removes the file extension
+    with zipfile.ZipFile(file, 'r') as zip_ref, Metrics.timed('unzip'):
+        zip_ref.extractall(os.path.join("files", fileName))
+    return os.path.join("files", fileName)
+
+def parseJson(file, content):
+    # The raw bytes are kept by the caller to hash the snapshot
+    log.debug("Parsing %s", os.path.basename(file))
+    with Metrics.timed('parse'):
+        return Ingestion.JsonFeed(content)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,149 @@
+"""
+Registry of the GTFS-RT feeds polled by TransitcrunchUpdater.py, one
+[feed:<name>] section of database.ini per feed, and the scheduler fetching
+them.
+
+Each feed is polled at its own interval. The feeds due at the same time are
+fetched concurrently, at most perhost requests at once to the same host, and
+with the ETag and Last-Modified of their previous response, so a feed that
+did not change costs a 304 instead of a download and a parse.
+"""
+from configparser import ConfigParser
+from urllib.parse import urlsplit
+import asyncio
+import os
+import Config
+import DBLoader
+
+CONFIG_SECTION_FEED = 'feed:'
+FEED_TYPES = ('tripupdates', 'vehiclepositions')
+# "header" sends the API key in the authname header, "query" in the authname
+# query parameter
+AUTH_NONE = 'none'
+AUTH_HEADER = 'header'
+AUTH_QUERY = 'query'
+FEED_DEFAULTS = {
+    'url': '',
+    # tripupdates or vehiclepositions
+    'type': '',
+    'auth': AUTH_NONE,
+    'authname': 'apikey',
+    'apikey': '',
+    # Seconds between two polls, the [poller] interval if 0
+    'interval': 0.0,
+    # Rows go to public.<prefix>trip_update and so on, the default tables
+    # if empty
+    'prefix': '',
+    # Only keep the raw snapshots of a feed that is not inserted
+    'ingest': True,
+    # Folder of the raw snapshots, by default the [poller] rawpath, in a
+    # sub-folder per table prefix
+    'rawpath': ''
+}
+
+class Feed:
+    """A feed of the registry, with the validators of its last response."""
+    def __init__(self, name, url, feedType, headers, params, interval, tablePrefix='',
+                 ingest=True, rawPath=None):
+        self.name = name
+        self.url = url
+        self.feedType = feedType
+        self.headers = headers
+        self.params = params
+        self.interval = interval
+        self.tablePrefix = tablePrefix
+        self.ingest = ingest
+        self.rawPath = rawPath
+        self.host = urlsplit(url).netloc
+        self.etag = None
+        self.lastModified = None
+        self.nextPoll = 0.0
+
+    def requestHeaders(self):
+        """Headers of the next request, conditional once a response was kept."""
+        headers = dict(self.headers)
+        if self.etag is not None:
+            headers['If-None-Match'] = self.etag
+        if self.lastModified is not None:
+            headers['If-Modified-Since'] = self.lastModified
+        return headers
+
+    def remember(self, response):
+        self.etag = response.headers.get('ETag')
+        self.lastModified = response.headers.get('Last-Modified')
+
+class FeedScheduler:
+    """Tells which feeds are due, and limits the requests running on each host."""
+    def __init__(self, feeds, perHost):
+        self.feeds = feeds
+        self.perHost = max(1, perHost)
+        self.hostLimits = {}
+        self.loop = None
+
+    def due(self, now):
+        """The feeds due at now, each scheduled for its next poll."""
+        due = []
+        for feed in self.feeds:
+            if feed.nextPoll <= now:
+                due.append(feed)
+                # Polls missed while the host was slow are skipped, not
+                # caught up with
+                feed.nextPoll += feed.interval
+                if feed.nextPoll <= now:
+                    feed.nextPoll = now + feed.interval
+        return due
+
+    def delay(self, now):
+        """Seconds until the next feed is due."""
+        return max(0, min(feed.nextPoll for feed in self.feeds) - now)
+
+    def hostLimit(self, feed):
+        # Semaphores belong to the event loop they were first used in
+        if self.loop is not asyncio.get_running_loop():
+            self.loop = asyncio.get_running_loop()
+            self.hostLimits = {}
+        limit = self.hostLimits.get(feed.host)
+        if limit is None:
+            limit = self.hostLimits[feed.host] = asyncio.Semaphore(self.perHost)
+        return limit
+
+def readFeeds(filename, defaultInterval, defaultRawPath=None):
+    """
+    The feeds of the [feed:<name>] sections, in the order of the file. Raw
+    snapshots are kept only for the feeds with a rawpath, or all of them
+    with a defaultRawPath.
+    """
+    parser = ConfigParser()
+    parser.read(filename)
+    feeds = []
+    for section in parser.sections():
+        if not section.startswith(CONFIG_SECTION_FEED):
+            continue
+        feeds.append(createFeed(section[len(CONFIG_SECTION_FEED):],
+            Config.sectionValues(parser, section, FEED_DEFAULTS), defaultInterval, defaultRawPath))
+    return feeds
+
+def createFeed(name, feedConfig, defaultInterval, defaultRawPath=None):
+    if not feedConfig['url']:
+        raise Exception('Feed {0} has no url'.format(name))
+    if feedConfig['type'] not in FEED_TYPES:
+        raise Exception('Feed {0} has type {1}, expected one of {2}'.format(
+            name, feedConfig['type'], ', '.join(FEED_TYPES)))
+    prefix = feedConfig['prefix']
+    # Checked now rather than on the first insert
+    DBLoader.prefixedTable(DBLoader.TRIP_UPDATE_TABLE, prefix)
+    headers = {}
+    params = {}
+    if feedConfig['auth'] == AUTH_HEADER:
+        headers[feedConfig['authname']] = feedConfig['apikey']
+    elif feedConfig['auth'] == AUTH_QUERY:
+        params[feedConfig['authname']] = feedConfig['apikey']
+    elif feedConfig['auth'] != AUTH_NONE:
+        raise Exception('Feed {0} has unknown auth {1}'.format(name, feedConfig['auth']))
+    rawPath = feedConfig['rawpath'] or None
+    if rawPath is None and defaultRawPath is not None:
+        # Snapshot archives only tell the feed type, so agencies need their
+        # own folders
+        rawPath = os.path.join(defaultRawPath, prefix.strip('_')) if prefix else defaultRawPath
+    return Feed(name, feedConfig['url'], feedConfig['type'], headers, params,
+        feedConfig['interval'] or defaultInterval, prefix, feedConfig['ingest'], rawPath)
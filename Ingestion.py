@@ -0,0 +1,361 @@
+from datetime import datetime
+from functools import lru_cache
+from itertools import islice
+from google.transit import gtfs_realtime_pb2
+import DBLoader
+import Metrics
+import json
+import io
+import struct
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+StopTimeUpdate = gtfs_realtime_pb2.TripUpdate.StopTimeUpdate
+VehiclePosition = gtfs_realtime_pb2.VehiclePosition
+# Enum values are stored under the same names MessageToJson gives them
+SCHEDULE_RELATIONSHIPS = dict((value, name) for name, value in
+    StopTimeUpdate.ScheduleRelationship.items())
+VEHICLE_STOP_STATUSES = dict((value, name) for name, value in
+    VehiclePosition.VehicleStopStatus.items())
+NO_DATA = StopTimeUpdate.NO_DATA
+TIMESTAMP_CACHE_SIZE = 65536
+
+class JsonFeed:
+    """
+    A feed saved by MessageToJson. With the optional ijson package, its
+    entities are parsed one at a time as the rows are built, so the whole
+    feed is never held as Python objects; otherwise it is parsed at once.
+    """
+    def __init__(self, content):
+        self.content = content
+        self.data = None
+        if ijson is None:
+            self.data = json.loads(content)
+
+    @property
+    def timestamp(self):
+        if self.data is not None:
+            return int(self.data.get('header', {}).get('timestamp', 0))
+        # The header comes before the entities, so only it is parsed
+        for value in ijson.items(io.BytesIO(self.content), 'header.timestamp'):
+            return int(value)
+        return 0
+
+    def entities(self):
+        if self.data is not None:
+            return iter(self.data.get('entity', []))
+        return ijson.items(io.BytesIO(self.content), 'entity.item', use_float=True)
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def toDatetime(epoch):
+    # A feed repeats the same few thousand epoch seconds over and over
+    return datetime.utcfromtimestamp(int(epoch))
+
+def shortestFloat(value):
+    """
+    Latitudes and longitudes are float32 in the protobuf. Returns the shortest
+    decimal that rounds to the same float32, like MessageToJson does, so the
+    stored values match the ones from the JSON files.
+    """
+    for precision in (6, 7, 8, 9):
+        rounded = float('{0:.{1}g}'.format(value, precision))
+        if struct.unpack('<f', struct.pack('<f', rounded))[0] == value:
+            return rounded
+    return value
+
+def parseFeed(content):
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(content)
+    return feed
+
+def feedTypeOf(name):
+    if "tripupdates" in name:
+        return "tripupdates"
+    if "vehiclepositions" in name:
+        return "vehiclepositions"
+    return None
+
+def feedTimestamp(feed):
+    """Header timestamp of a JsonFeed or a FeedMessage."""
+    if isinstance(feed, JsonFeed):
+        return feed.timestamp
+    return feed.header.timestamp
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+def insertFeed(name, feed, conn, tripUpdateIds, loaderMode, tripDedup=None,
+               batchSize=DBLoader.LOADER_DEFAULTS['batchsize'], latest=None, staticGtfs=None,
+               tablePrefix=''):
+    """
+    Inserts a tripupdates or vehiclepositions feed, a JsonFeed or a
+    FeedMessage, in the caller's transaction. With a LatestRows, its
+    latest-state rows are added to it, for the caller to upsert before the
+    commit. With a StaticGtfs cache, stop times are linked to the schedule.
+    The rows go to the tables named with tablePrefix. Returns False for other
+    feeds.
+    """
+    feedType = feedTypeOf(name)
+    if feedType is None:
+        return False
+    # Rows are built as they are inserted, so this also times the transform
+    with Metrics.timed('insert'):
+        if feedType == "tripupdates":
+            insertTripUpdates(feed, conn, tripUpdateIds, loaderMode, tripDedup, batchSize, latest,
+                staticGtfs, tablePrefix)
+        else:
+            insertVehiclePositions(feed, conn, loaderMode, batchSize, latest, tablePrefix)
+    Metrics.increment('feeds_inserted_total', feed=feedType)
+    return True
+
+def insertTripUpdates(feed, conn, tripUpdateIds, loaderMode, tripDedup=None,
+                      batchSize=DBLoader.LOADER_DEFAULTS['batchsize'], latest=None,
+                      staticGtfs=None, tablePrefix=''):
+    """
+    Sends the trip_update and stop_time_update rows of a feed to the database
+    batchSize trips at a time, so memory use depends on the batch size and
+    not on the size of the feed.
+    """
+    tripCount = 0
+    for trips in batched(tripUpdateRows(feed, staticGtfs), batchSize):
+        tripCount += len(trips)
+        # Drops the unchanged trips, then numbers the others from the
+        # trip_update sequence in one round trip at most
+        paramsTripUpdate, paramsStopUpdate = assignTripUpdateIds(
+            trips, conn, tripUpdateIds, tripDedup)
+        with conn.cursor() as cur:
+            DBLoader.loadRows(cur, DBLoader.prefixedTable(DBLoader.TRIP_UPDATE_TABLE, tablePrefix),
+                DBLoader.TRIP_UPDATE_COLUMNS, paramsTripUpdate, loaderMode)
+            DBLoader.loadRows(cur, DBLoader.prefixedTable(DBLoader.STOP_TIME_UPDATE_TABLE, tablePrefix),
+                DBLoader.STOP_TIME_UPDATE_COLUMNS, paramsStopUpdate, loaderMode)
+            if latest is not None:
+                latest.addStopTimes(paramsTripUpdate, paramsStopUpdate)
+    if tripDedup is not None:
+        tripDedup.resize(tripCount)
+
+def insertVehiclePositions(feed, conn, loaderMode,
+                           batchSize=DBLoader.LOADER_DEFAULTS['batchsize'], latest=None,
+                           tablePrefix=''):
+    for rows in batched(vehiclePositionRows(feed), batchSize):
+        with conn.cursor() as cur:
+            DBLoader.loadRows(cur, DBLoader.prefixedTable(DBLoader.VEHICLE_POSITION_TABLE, tablePrefix),
+                DBLoader.VEHICLE_POSITION_COLUMNS, rows, loaderMode)
+            if latest is not None:
+                latest.addVehicles(rows)
+
+class LatestRows:
+    """
+    The newest vehicle_latest and stop_time_latest rows of a transaction. The
+    feeds of the transaction add their rows batch after batch, and upsert()
+    sends them once, in key order, just before the commit.
+    """
+    def __init__(self, tablePrefix=''):
+        self.tablePrefix = tablePrefix
+        self.stopTimes = {}
+        self.vehicles = {}
+
+    def addStopTimes(self, paramsTripUpdate, paramsStopUpdate):
+        """Keeps the newest prediction of each (trip, stop) of the rows."""
+        trips = dict((row[0], row[1:4]) for row in paramsTripUpdate)
+        for stopId, stopSequence, tripUpdateId, departureTime, arrivalTime, relationship, \
+                createdAt, stopTimeId in paramsStopUpdate:
+            tripId, startTime, routeId = trips[tripUpdateId]
+            keepNewest(self.stopTimes, (tripId, startTime, stopSequence), (tripId, startTime,
+                stopSequence, stopId, routeId, tripUpdateId, departureTime, arrivalTime,
+                relationship, createdAt))
+
+    def addVehicles(self, rows):
+        for row in rows:
+            keepNewest(self.vehicles, (row[0],), row)
+
+    def upsert(self, conn):
+        # One statement per table, always stop times first, so concurrent
+        # transactions lock the keys they share in the same order
+        with conn.cursor() as cur:
+            if self.stopTimes:
+                DBLoader.upsertRows(cur,
+                    DBLoader.prefixedTable(DBLoader.STOP_TIME_LATEST_TABLE, self.tablePrefix),
+                    DBLoader.STOP_TIME_LATEST_COLUMNS, DBLoader.STOP_TIME_LATEST_KEY,
+                    inKeyOrder(self.stopTimes))
+            if self.vehicles:
+                DBLoader.upsertRows(cur,
+                    DBLoader.prefixedTable(DBLoader.VEHICLE_LATEST_TABLE, self.tablePrefix),
+                    DBLoader.VEHICLE_LATEST_COLUMNS, DBLoader.VEHICLE_LATEST_KEY,
+                    inKeyOrder(self.vehicles))
+        self.stopTimes = {}
+        self.vehicles = {}
+
+def keepNewest(latest, key, row):
+    # A key may only be upserted once per statement. Rows are compared on
+    # created_at, their last column; a row without one never wins.
+    current = latest.get(key)
+    if current is None or (row[-1] is not None and (current[-1] is None or row[-1] >= current[-1])):
+        latest[key] = row
+
+def inKeyOrder(latest):
+    # The upsert locks each key it meets, even when the stored row is newer.
+    # Transactions upserting the same keys (insert workers, a backfill next
+    # to the poller) lock them in the same order, so they wait instead of
+    # deadlocking.
+    return [latest[key] for key in sorted(latest, key=lambda key: [(value is not None, value)
+        for value in key])]
+
+def assignTripUpdateIds(trips, conn, tripUpdateIds, tripDedup=None):
+    """
+    Takes (tripUpdate, stopUpdates) rows built without their trip_update_id,
+    drops the trips that did not change since they were last ingested, and
+    returns the trip_update and stop_time_update rows of the others numbered
+    with IDs reserved from the sequence.
+    """
+    trips = filterChangedTrips(trips, tripDedup)
+    ids = tripUpdateIds.reserve(conn, len(trips))
+    paramsTripUpdate = []
+    paramsStopUpdate = []
+    for (tripUpdate, stopUpdates), tripUpdateId in zip(trips, ids):
+        paramsTripUpdate.append((tripUpdateId,) + tripUpdate)
+        for stopUpdate in stopUpdates:
+            paramsStopUpdate.append(stopUpdate[:2] + (tripUpdateId,) + stopUpdate[2:])
+    return paramsTripUpdate, paramsStopUpdate
+
+def filterChangedTrips(trips, tripDedup=None):
+    if tripDedup is None:
+        return trips
+    # Trips are keyed by trip_id and start time, and versioned by their
+    # timestamp and a hash of their rows
+    return tripDedup.filter([((trip[0][0], trip[0][1]), trip[0][3],
+        hash((trip[0], tuple(trip[1]))), trip) for trip in trips])
+
+def tripUpdateRows(feed, staticGtfs=None):
+    """
+    Yields the (tripUpdate, stopUpdates) rows of each trip of a feed, without
+    their trip_update_id. stop_time_id is only filled with a StaticGtfs cache.
+    """
+    if isinstance(feed, JsonFeed):
+        return tripUpdateRowsFromJson(feed.entities(), staticGtfs)
+    return tripUpdateRowsFromFeed(feed, staticGtfs)
+
+def vehiclePositionRows(feed):
+    if isinstance(feed, JsonFeed):
+        return vehiclePositionRowsFromJson(feed.entities())
+    return vehiclePositionRowsFromFeed(feed)
+
+def tripUpdateRowsFromJson(entities, staticGtfs=None):
+    for en in entities:
+        tripUp = en['tripUpdate']
+        if tripUp["stopTimeUpdate"][0]['scheduleRelationship'] == 'NO_DATA':
+            continue
+        timestamp = None
+        if 'timestamp' in tripUp:
+            timestamp = toDatetime(tripUp['timestamp'])
+        trip = tripUp['trip']
+        tripUpdate = (
+            trip['tripId'],
+            trip['startDate'] + ' ' + trip['startTime'],
+            trip['routeId'],
+            timestamp
+        )
+        scheduledTrip = None
+        if staticGtfs is not None:
+            scheduledTrip = staticGtfs.trip(trip['tripId'], trip['routeId'])
+        stopUpdates = []
+        for stopTimeUpdate in tripUp["stopTimeUpdate"]:
+            departureTime = None
+            arrivalTime = None
+            if 'departure' in stopTimeUpdate:
+                departureTime = toDatetime(stopTimeUpdate['departure']['time'])
+            if 'arrival' in stopTimeUpdate:
+                arrivalTime = toDatetime(stopTimeUpdate['arrival']['time'])
+            stopTimeId = None
+            if scheduledTrip is not None:
+                stopTimeId = staticGtfs.stopTimeId(scheduledTrip, stopTimeUpdate['stopSequence'],
+                    stopTimeUpdate['stopId'])
+            stopUpdates.append((
+                stopTimeUpdate['stopId'],
+                stopTimeUpdate['stopSequence'],
+                departureTime,
+                arrivalTime,
+                stopTimeUpdate['scheduleRelationship'],
+                timestamp,
+                stopTimeId
+            ))
+        yield (tripUpdate, stopUpdates)
+
+def tripUpdateRowsFromFeed(feed, staticGtfs=None):
+    # Same rows as tripUpdateRowsFromJson, straight from a FeedMessage
+    for en in feed.entity:
+        if not en.HasField('trip_update'):
+            continue
+        tripUp = en.trip_update
+        if not tripUp.stop_time_update or tripUp.stop_time_update[0].schedule_relationship == NO_DATA:
+            continue
+        timestamp = None
+        if tripUp.HasField('timestamp'):
+            timestamp = toDatetime(tripUp.timestamp)
+        trip = tripUp.trip
+        tripUpdate = (
+            trip.trip_id,
+            trip.start_date + ' ' + trip.start_time,
+            trip.route_id,
+            timestamp
+        )
+        scheduledTrip = None
+        if staticGtfs is not None:
+            scheduledTrip = staticGtfs.trip(trip.trip_id, trip.route_id)
+        stopUpdates = []
+        for stopTimeUpdate in tripUp.stop_time_update:
+            departureTime = None
+            arrivalTime = None
+            if stopTimeUpdate.HasField('departure'):
+                departureTime = toDatetime(stopTimeUpdate.departure.time)
+            if stopTimeUpdate.HasField('arrival'):
+                arrivalTime = toDatetime(stopTimeUpdate.arrival.time)
+            stopTimeId = None
+            if scheduledTrip is not None:
+                stopTimeId = staticGtfs.stopTimeId(scheduledTrip, stopTimeUpdate.stop_sequence,
+                    stopTimeUpdate.stop_id)
+            stopUpdates.append((
+                stopTimeUpdate.stop_id,
+                stopTimeUpdate.stop_sequence,
+                departureTime,
+                arrivalTime,
+                SCHEDULE_RELATIONSHIPS[stopTimeUpdate.schedule_relationship],
+                timestamp,
+                stopTimeId
+            ))
+        yield (tripUpdate, stopUpdates)
+
+def vehiclePositionRowsFromJson(entities):
+    for en in entities:
+        vehicle = en['vehicle']
+        yield (
+            vehicle['vehicle']['id'],
+            vehicle['trip']['tripId'],
+            vehicle['currentStopSequence'],
+            vehicle['currentStatus'],
+            vehicle['position']['latitude'],
+            vehicle['position']['longitude'],
+            toDatetime(vehicle['timestamp'])
+        )
+
+def vehiclePositionRowsFromFeed(feed):
+    for en in feed.entity:
+        if not en.HasField('vehicle'):
+            continue
+        vehicle = en.vehicle
+        yield (
+            vehicle.vehicle.id,
+            vehicle.trip.trip_id,
+            vehicle.current_stop_sequence,
+            VEHICLE_STOP_STATUSES[vehicle.current_status],
+            shortestFloat(vehicle.position.latitude),
+            shortestFloat(vehicle.position.longitude),
+            toDatetime(vehicle.timestamp)
+        )
@@ -0,0 +1,113 @@
+from datetime import datetime
+from threading import Lock
+import sqlite3
+
+CONFIG_SECTION_LEDGER = 'ledger'
+LEDGER_DEFAULTS = {
+    'path': 'ledger.sqlite',
+    # The next run lists files created up to this many minutes before the
+    # watermark, in case Drive lists some of them late. Files already in
+    # the ledger are skipped anyway.
+    'overlapminutes': 60
+}
+WATERMARK_KEY = 'createdtime'
+# Seconds a backfill process waits for another one writing to the ledger
+BUSY_TIMEOUT = 60.0
+
+class Ledger:
+    """
+    Local SQLite record of the Drive files already inserted in the database,
+    of the members of the files being inserted whose transaction committed,
+    and of the high-water createdTime of the last complete run. Shared by
+    the pipeline threads, and opened by each backfill process.
+    """
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        self.lock = Lock()
+        self.highWater = None
+        with self.lock:
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS processed_file (
+                    file_id TEXT PRIMARY KEY,
+                    name TEXT,
+                    created_time TEXT,
+                    processed_at TEXT)
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS processed_member (
+                    file_id TEXT,
+                    member TEXT,
+                    PRIMARY KEY (file_id, member))
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS watermark (
+                    key TEXT PRIMARY KEY,
+                    value TEXT)
+            """)
+            self.conn.commit()
+
+    def isProcessed(self, fileId):
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT 1 FROM processed_file WHERE file_id = ?", (fileId,))
+            return cur.fetchone() is not None
+
+    def markProcessed(self, fileId, name, createdTime):
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO processed_file VALUES (?, ?, ?, ?)",
+                (fileId, name, createdTime, datetime.utcnow().isoformat()))
+            # The whole file is recorded now
+            self.conn.execute("DELETE FROM processed_member WHERE file_id = ?", (fileId,))
+            self.conn.commit()
+
+    def processedMembers(self, fileId):
+        """Members of a file already committed by a run that did not finish it."""
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT member FROM processed_member WHERE file_id = ?", (fileId,))
+            return set(row[0] for row in cur.fetchall())
+
+    def markMembersProcessed(self, fileId, members):
+        # Called once their transaction committed; a crash in between only
+        # inserts the members of that transaction again
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO processed_member VALUES (?, ?)",
+                [(fileId, member) for member in members])
+            self.conn.commit()
+
+    def getWatermark(self):
+        with self.lock:
+            cur = self.conn.execute(
+                "SELECT value FROM watermark WHERE key = ?", (WATERMARK_KEY,))
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+
+    def seen(self, createdTime):
+        """
+        Records the createdTime of a listed file. The highest one becomes the
+        watermark once commitWatermark() is called at the end of a run.
+        """
+        with self.lock:
+            if self.highWater is None or createdTime > self.highWater:
+                self.highWater = createdTime
+
+    def commitWatermark(self):
+        # Only called when every listed file made it to the database, so a
+        # failed file is listed again on the next run.
+        with self.lock:
+            if self.highWater is None:
+                return
+            current = self.conn.execute(
+                "SELECT value FROM watermark WHERE key = ?", (WATERMARK_KEY,)).fetchone()
+            if current is not None and current[0] >= self.highWater:
+                return
+            self.conn.execute(
+                "INSERT OR REPLACE INTO watermark VALUES (?, ?)",
+                (WATERMARK_KEY, self.highWater))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
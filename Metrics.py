@@ -0,0 +1,183 @@
+"""
+Counters and latency histograms shared by the scripts, exposed as Prometheus
+text on an optional HTTP endpoint and as a JSON summary logged or written at
+the end of a run.
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from threading import Lock
+from threading import Thread
+import bisect
+import json
+import logging
+import time
+
+CONFIG_SECTION_METRICS = 'metrics'
+METRICS_DEFAULTS = {
+    'loglevel': 'INFO',
+    # Port of the Prometheus endpoint, 0 to disable it
+    'port': 0,
+    # File the JSON summary is written to at the end of a run, logged if empty
+    'summary': ''
+}
+PREFIX = 'drivedownloader_'
+# Upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+LOG_FORMAT = '%(asctime)s %(levelname)s %(message)s'
+
+log = logging.getLogger(__name__)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.count += other.count
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+class Registry:
+    """
+    Counters and histograms keyed by name and labels, safe to share between
+    threads.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def takeState(self):
+        """Returns the metrics recorded so far and starts over from zero."""
+        with self.lock:
+            state = (self.counters, self.histograms)
+            self.counters = {}
+            self.histograms = {}
+        return state
+
+    def merge(self, state):
+        # Adds the metrics taken from another registry, e.g. a worker process
+        counters, histograms = state
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, other in histograms.items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.merge(other)
+
+    def prometheusText(self):
+        lines = []
+        with self.lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append("{0}{1}{2} {3}".format(PREFIX, name, formatLabels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append("{0}{1}_bucket{2} {3}".format(PREFIX, name,
+                        formatLabels(labels + (('le', str(bound)),)), cumulative))
+                lines.append("{0}{1}_sum{2} {3}".format(PREFIX, name, formatLabels(labels), histogram.sum))
+                lines.append("{0}{1}_count{2} {3}".format(PREFIX, name, formatLabels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        with self.lock:
+            counters = dict((name + formatLabels(labels), value)
+                for (name, labels), value in sorted(self.counters.items()))
+            histograms = dict((name + formatLabels(labels), {
+                    'count': histogram.count,
+                    'seconds': round(histogram.sum, 3),
+                    'mean': round(histogram.sum / histogram.count, 4) if histogram.count else 0,
+                    'max': round(histogram.max, 4)
+                }) for (name, labels), histogram in sorted(self.histograms.items()))
+        return {'counters': counters, 'latencies': histograms}
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(key, value) for key, value in labels) + '}'
+
+REGISTRY = Registry()
+
+def increment(name, amount=1, **labels):
+    REGISTRY.increment(name, amount, **labels)
+
+def observe(name, value, **labels):
+    REGISTRY.observe(name, value, **labels)
+
+@contextmanager
+def timed(stage):
+    """Records the time spent in the block in the stage latency histogram."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe('stage_seconds', time.perf_counter() - started, stage=stage)
+
+def setupLogging(level):
+    logging.basicConfig(format=LOG_FORMAT, level=getattr(logging, str(level).upper(), logging.INFO))
+
+def startServer(port):
+    """Serves the metrics as Prometheus text on http://<host>:<port>/metrics."""
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = REGISTRY.prometheusText().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            log.debug(format, *args)
+
+    server = ThreadingHTTPServer(('', port), Handler)
+    thread = Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    log.info("Serving metrics on port %d", port)
+    return server
+
+def reportSummary(path=''):
+    summary = json.dumps(REGISTRY.summary(), indent=2)
+    if path:
+        with open(path, 'w') as f:
+            f.write(summary)
+        log.info("Metrics written to %s", path)
+    else:
+        log.info("Metrics: %s", summary)
+
+def start(metricsConfig):
+    """Sets up logging and the Prometheus endpoint from the [metrics] section."""
+    setupLogging(metricsConfig['loglevel'])
+    if metricsConfig['port']:
+        return startServer(metricsConfig['port'])
+    return None
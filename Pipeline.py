@@ -0,0 +1,105 @@
+from threading import Event
+from threading import Lock
+from threading import Thread
+from queue import Queue
+from queue import Empty
+from queue import Full
+import logging
+
+log = logging.getLogger(__name__)
+
+# How long a blocked worker waits on a queue before checking if the
+# pipeline has failed. Keeps a crashed stage from hanging the whole run.
+POLL_INTERVAL = 0.5
+
+# Pushed once per worker of the next stage when a stage is finished.
+_STOP = object()
+
+class Stage:
+    def __init__(self, name, work, workers=1, queueSize=0):
+        self.name = name
+        self.work = work
+        self.workers = max(1, int(workers))
+        self.queue = Queue(maxsize=max(0, int(queueSize)))
+        self.running = self.workers
+        self.lock = Lock()
+
+class Pipeline:
+    """
+    Chain of stages, each with its own worker threads and bounded input queue.
+    A stage's work function receives one item and returns an iterable of items
+    for the next stage (or None). If any worker raises, every stage stops and
+    run() returns False instead of waiting forever on a queue.
+    """
+    def __init__(self):
+        self.stages = []
+        self.failed = Event()
+        self.errors = []
+        self.errorsLock = Lock()
+
+    def addStage(self, name, work, workers=1, queueSize=0):
+        self.stages.append(Stage(name, work, workers, queueSize))
+        return self
+
+    def run(self, items):
+        threads = []
+        for index, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                worker = Thread(target=self._doWork, args=(index,),
+                                name="{0}-{1}".format(stage.name, i))
+                worker.daemon = True
+                worker.start()
+                threads.append(worker)
+        first = self.stages[0]
+        for item in items:
+            if not self._put(first, item):
+                break
+        for i in range(first.workers):
+            self._put(first, _STOP)
+        for worker in threads:
+            worker.join()
+        return not self.failed.is_set()
+
+    def _doWork(self, index):
+        stage = self.stages[index]
+        nextStage = self.stages[index + 1] if index + 1 < len(self.stages) else None
+        try:
+            while not self.failed.is_set():
+                item = self._get(stage)
+                if item is _STOP or item is None:
+                    break
+                results = stage.work(item)
+                if results is None or nextStage is None:
+                    continue
+                for result in results:
+                    if not self._put(nextStage, result):
+                        return
+        except Exception as e:
+            with self.errorsLock:
+                self.errors.append((stage.name, e))
+            log.exception("Worker %s failed", stage.name)
+            self.failed.set()
+        finally:
+            with stage.lock:
+                stage.running -= 1
+                lastWorker = stage.running == 0
+            if lastWorker and nextStage is not None:
+                for i in range(nextStage.workers):
+                    self._put(nextStage, _STOP)
+
+    def _put(self, stage, item):
+        while not self.failed.is_set():
+            try:
+                stage.queue.put(item, timeout=POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _get(self, stage):
+        while not self.failed.is_set():
+            try:
+                return stage.queue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+        return None
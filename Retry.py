@@ -0,0 +1,33 @@
+import logging
+import random
+import time
+import Metrics
+
+log = logging.getLogger(__name__)
+
+RETRY_DEFAULTS = {
+    'retries': 6,
+    'retrybasedelay': 1.0,
+    'retrymaxdelay': 64.0
+}
+
+def callWithRetries(func, isRetryable, retries=6, baseDelay=1.0, maxDelay=64.0):
+    """
+    Calls func until it succeeds, sleeping with exponential backoff and random
+    jitter between attempts: min(maxDelay, baseDelay * 2^n) + up to baseDelay.
+    Errors for which isRetryable returns False, or the last error once the
+    retries are exhausted, are raised to the caller.
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as e:
+            if attempt >= retries or not isRetryable(e):
+                raise
+            delay = min(maxDelay, baseDelay * 2 ** attempt) + random.uniform(0, baseDelay)
+            attempt += 1
+            Metrics.increment('retries_total', error=type(e).__name__)
+            log.warning("%s: %s, retrying in %.1fs (%d/%d)",
+                type(e).__name__, e, delay, attempt, retries)
+            time.sleep(delay)
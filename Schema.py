@@ -0,0 +1,346 @@
+"""
+Creates and maintains the target tables, range-partitioned by month on
+created_at. Rows inserted into trip_update, stop_time_update and
+vehicle_position are routed to their partition by Postgres, so the loaders
+keep inserting into the same table names. Rows without created_at, or
+outside every monthly partition, land in the <table>_default partition.
+
+    python Schema.py create            creates the partitioned and latest-state tables
+    python Schema.py migrate           partitions the existing tables in place
+    python Schema.py partitions        creates the partitions of the coming months
+    python Schema.py drop-indexes      drops the secondary indexes before a bulk load
+    python Schema.py create-indexes    builds them again
+
+Every command takes --prefix to work on the tables of a table prefix, e.g.
+public.rtm_trip_update for --prefix rtm_, see FeedRegistry.py.
+"""
+from datetime import datetime
+import argparse
+import logging
+import re
+import psycopg2
+import Config
+import DBLoader
+import Metrics
+
+CONFIG_FILENAME = Config.CONFIG_FILENAME
+CONFIG_SECTION_POSTGRES = 'postgresql'
+CONFIG_SECTION_SCHEMA = 'schema'
+SCHEMA_DEFAULTS = {
+    # Monthly partitions created ahead of the current month
+    'partitionsahead': 2
+}
+PARTITION_KEY = 'created_at'
+LEGACY_SUFFIX = '_legacy'
+DEFAULT_SUFFIX = '_default'
+PARTITIONED_TABLES = {
+    DBLoader.TRIP_UPDATE_TABLE: """
+        trip_update_id bigint NOT NULL,
+        trip_id text,
+        start_time timestamp,
+        route_id text,
+        created_at timestamp""",
+    DBLoader.STOP_TIME_UPDATE_TABLE: """
+        stop_id text,
+        stop_sequence integer,
+        trip_update_id bigint,
+        departure_time timestamp,
+        arrival_time timestamp,
+        schedule_relationship text,
+        created_at timestamp,
+        stop_time_id integer""",
+    DBLoader.VEHICLE_POSITION_TABLE: """
+        vehicle_id text,
+        trip_id text,
+        current_stop_sequence integer,
+        current_status text,
+        vehicle_lat double precision,
+        vehicle_lon double precision,
+        created_at timestamp"""
+}
+# Columns added after the tables were first created, as (table, column,
+# type), added to existing tables by addColumns
+ADDED_COLUMNS = (
+    (DBLoader.STOP_TIME_UPDATE_TABLE, 'stop_time_id', 'integer'),
+)
+# One row per vehicle and per (trip, stop), replaced by newer rows. They
+# stay as large as the active fleet, so they are not partitioned.
+LATEST_TABLES = {
+    DBLoader.VEHICLE_LATEST_TABLE: """
+        vehicle_id text PRIMARY KEY,
+        trip_id text,
+        current_stop_sequence integer,
+        current_status text,
+        vehicle_lat double precision,
+        vehicle_lon double precision,
+        created_at timestamp""",
+    DBLoader.STOP_TIME_LATEST_TABLE: """
+        trip_id text,
+        start_time timestamp,
+        stop_sequence integer,
+        stop_id text,
+        route_id text,
+        trip_update_id bigint,
+        departure_time timestamp,
+        arrival_time timestamp,
+        schedule_relationship text,
+        created_at timestamp,
+        PRIMARY KEY (trip_id, start_time, stop_sequence)"""
+}
+# (name, table, columns). Created on the partitioned tables, so Postgres
+# builds them on every partition.
+SECONDARY_INDEXES = (
+    ('public.trip_update_trip_update_id_idx', DBLoader.TRIP_UPDATE_TABLE, 'trip_update_id'),
+    ('public.trip_update_trip_id_idx', DBLoader.TRIP_UPDATE_TABLE, 'trip_id, start_time'),
+    ('public.stop_time_update_trip_update_id_idx', DBLoader.STOP_TIME_UPDATE_TABLE, 'trip_update_id'),
+    ('public.vehicle_position_vehicle_id_idx', DBLoader.VEHICLE_POSITION_TABLE, 'vehicle_id, created_at')
+)
+# Serializes schema changes between the scripts, which all create the
+# partitions they need when starting.
+SCHEMA_LOCK = 'schema'
+PARTITION_BOUND = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+log = logging.getLogger(__name__)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Creates and maintains the partitioned tables.")
+    parser.add_argument('command',
+        choices=['create', 'migrate', 'partitions', 'drop-indexes', 'create-indexes'])
+    parser.add_argument('--ahead', type=int,
+        help="months of partitions to create ahead, [schema] partitionsahead by default")
+    parser.add_argument('--prefix', default='',
+        help="prefix of the tables to work on, e.g. rtm_, none by default")
+    args = parser.parse_args()
+    Metrics.setupLogging('INFO')
+    postGresConfig = Config.readConfig(CONFIG_SECTION_POSTGRES, CONFIG_FILENAME)
+    schemaConfig = Config.readConfig(CONFIG_SECTION_SCHEMA, CONFIG_FILENAME, SCHEMA_DEFAULTS)
+    monthsAhead = args.ahead if args.ahead is not None else schemaConfig['partitionsahead']
+
+    conn = psycopg2.connect(**postGresConfig)
+    try:
+        prefix = args.prefix
+        if args.command == 'create':
+            createTables(conn, prefix)
+            addColumns(conn, prefix)
+            createLatestTables(conn, prefix)
+            createIndexes(conn, prefix)
+            ensureFuturePartitions(conn, monthsAhead, prefix)
+        elif args.command == 'migrate':
+            # Before the legacy tables are attached, which needs the same columns
+            addColumns(conn, prefix)
+            for table in PARTITIONED_TABLES:
+                migrateTable(conn, table, prefix)
+            createLatestTables(conn, prefix)
+            createIndexes(conn, prefix)
+            ensureFuturePartitions(conn, monthsAhead, prefix)
+        elif args.command == 'partitions':
+            ensureFuturePartitions(conn, monthsAhead, prefix)
+        elif args.command == 'drop-indexes':
+            dropIndexes(conn, prefix)
+        elif args.command == 'create-indexes':
+            createIndexes(conn, prefix)
+    finally:
+        conn.close()
+
+def monthStart(date):
+    return datetime(date.year, date.month, 1)
+
+def addMonths(date, months):
+    month = date.month - 1 + months
+    return datetime(date.year + month // 12, month % 12 + 1, 1)
+
+def partitionName(table, start):
+    return "{0}_y{1:04d}m{2:02d}".format(table, start.year, start.month)
+
+def isPartitioned(cur, table):
+    cur.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", (table,))
+    return cur.fetchone() is not None
+
+def lockSchema(cur):
+    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (SCHEMA_LOCK,))
+
+def createTables(conn, prefix=''):
+    """Creates the missing partitioned tables, and returns whether there were any."""
+    created = False
+    with conn.cursor() as cur:
+        lockSchema(cur)
+        for table in PARTITIONED_TABLES:
+            name = DBLoader.prefixedTable(table, prefix)
+            cur.execute("SELECT to_regclass(%s)", (name,))
+            if cur.fetchone()[0] is None:
+                createTable(cur, table, prefix)
+                created = True
+            elif not isPartitioned(cur, name):
+                log.warning("%s already exists unpartitioned, see the migrate command", name)
+    conn.commit()
+    return created
+
+def addColumns(conn, prefix=''):
+    with conn.cursor() as cur:
+        lockSchema(cur)
+        for table, column, type in ADDED_COLUMNS:
+            table = DBLoader.prefixedTable(table, prefix)
+            cur.execute("SELECT to_regclass(%s)", (table,))
+            if cur.fetchone()[0] is None:
+                continue
+            cur.execute("""
+                SELECT 1 FROM pg_attribute
+                WHERE attrelid = to_regclass(%s) AND attname = %s AND NOT attisdropped
+            """, (table, column))
+            if cur.fetchone() is None:
+                # Also added to every partition
+                cur.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(table, column, type))
+                log.info("Added %s.%s", table, column)
+    conn.commit()
+
+def createLatestTables(conn, prefix=''):
+    with conn.cursor() as cur:
+        lockSchema(cur)
+        for table, columns in LATEST_TABLES.items():
+            cur.execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(
+                DBLoader.prefixedTable(table, prefix), columns))
+    conn.commit()
+
+def createTable(cur, table, prefix=''):
+    name = DBLoader.prefixedTable(table, prefix)
+    cur.execute("CREATE TABLE {0} ({1}) PARTITION BY RANGE ({2})".format(
+        name, PARTITIONED_TABLES[table], PARTITION_KEY))
+    createDefaultPartition(cur, name)
+    log.info("Created %s", name)
+
+def createDefaultPartition(cur, table):
+    cur.execute("CREATE TABLE IF NOT EXISTS {0}{1} PARTITION OF {0} DEFAULT".format(
+        table, DEFAULT_SUFFIX))
+
+def migrateTable(conn, table, prefix=''):
+    """
+    Turns an unpartitioned table into a partitioned one without copying it:
+    the table is renamed to <table>_legacy and attached as the partition of
+    every row before the month following its newest created_at. Rows without
+    created_at are moved to the default partition first.
+    """
+    definition, table = table, DBLoader.prefixedTable(table, prefix)
+    with conn.cursor() as cur:
+        lockSchema(cur)
+        cur.execute("SELECT to_regclass(%s)", (table,))
+        if cur.fetchone()[0] is None:
+            createTable(cur, definition, prefix)
+            conn.commit()
+            return
+        if isPartitioned(cur, table):
+            log.info("%s is already partitioned", table)
+            conn.commit()
+            return
+        cur.execute("LOCK TABLE {0} IN ACCESS EXCLUSIVE MODE".format(table))
+        cur.execute("SELECT MAX({0}) FROM {1}".format(PARTITION_KEY, table))
+        newest = cur.fetchone()[0]
+        boundary = boundLiteral(addMonths(monthStart(newest or datetime.utcnow()), 1))
+        legacy = table + LEGACY_SUFFIX
+        cur.execute("ALTER TABLE {0} RENAME TO {1}".format(table, legacy.split('.')[-1]))
+        cur.execute("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS) PARTITION BY RANGE ({2})".format(
+            table, legacy, PARTITION_KEY))
+        createDefaultPartition(cur, table)
+        cur.execute("""
+            WITH moved AS (DELETE FROM {0} WHERE {2} IS NULL RETURNING *)
+            INSERT INTO {1}{3} SELECT * FROM moved
+        """.format(legacy, table, PARTITION_KEY, DEFAULT_SUFFIX))
+        # With a constraint already matching the partition bounds, the
+        # attach does not need to scan the table again.
+        cur.execute("""
+            ALTER TABLE {0} ADD CONSTRAINT {1}_bounds
+            CHECK ({2} IS NOT NULL AND {2} < %s)
+        """.format(legacy, legacy.split('.')[-1], PARTITION_KEY), (boundary,))
+        cur.execute("ALTER TABLE {0} ATTACH PARTITION {1} FOR VALUES FROM (MINVALUE) TO (%s)".format(
+            table, legacy), (boundary,))
+        log.info("Partitioned %s, existing rows kept in %s", table, legacy)
+    conn.commit()
+
+def partitionRanges(cur, table):
+    """(start, end) of the range partitions of a table, None for MINVALUE/MAXVALUE."""
+    cur.execute("""
+        SELECT pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass(%s)
+    """, (table,))
+    ranges = []
+    for (bound,) in cur.fetchall():
+        match = PARTITION_BOUND.search(bound)
+        if match is not None:
+            ranges.append(tuple(parseBound(value) for value in match.groups()))
+    return ranges
+
+def boundLiteral(date):
+    # Partition bounds must be plain literals, not the casts psycopg2 renders
+    # datetimes as.
+    return date.isoformat(' ')
+
+def parseBound(value):
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.fromisoformat(value.strip("'"))
+
+def overlaps(start, end, ranges):
+    for rangeStart, rangeEnd in ranges:
+        if (rangeStart is None or rangeStart < end) and (rangeEnd is None or start < rangeEnd):
+            return True
+    return False
+
+def ensurePartitions(conn, start, end, prefix=''):
+    """
+    Creates the monthly partitions covering [start, end) that do not exist
+    yet, on every partitioned table. Does nothing on unpartitioned tables.
+    """
+    with conn.cursor() as cur:
+        lockSchema(cur)
+        for table in PARTITIONED_TABLES:
+            table = DBLoader.prefixedTable(table, prefix)
+            if not isPartitioned(cur, table):
+                continue
+            ranges = partitionRanges(cur, table)
+            month = monthStart(start)
+            while month < end:
+                nextMonth = addMonths(month, 1)
+                if not overlaps(month, nextMonth, ranges):
+                    createPartition(cur, table, month, nextMonth)
+                    ranges.append((month, nextMonth))
+                month = nextMonth
+    conn.commit()
+
+def ensureFuturePartitions(conn, monthsAhead, prefix=''):
+    thisMonth = monthStart(datetime.utcnow())
+    ensurePartitions(conn, thisMonth, addMonths(thisMonth, monthsAhead + 1), prefix)
+
+def createPartition(cur, table, start, end):
+    # Rows of that month already in the default partition are moved to the
+    # new one, otherwise Postgres refuses to attach it.
+    partition = partitionName(table, start)
+    cur.execute("CREATE TABLE {0} (LIKE {1} INCLUDING DEFAULTS)".format(partition, table))
+    cur.execute("""
+        WITH moved AS (DELETE FROM {0}{1} WHERE {2} >= %s AND {2} < %s RETURNING *)
+        INSERT INTO {3} SELECT * FROM moved
+    """.format(table, DEFAULT_SUFFIX, PARTITION_KEY, partition), (start, end))
+    cur.execute("ALTER TABLE {0} ATTACH PARTITION {1} FOR VALUES FROM (%s) TO (%s)".format(
+        table, partition), (boundLiteral(start), boundLiteral(end)))
+    log.info("Created partition %s", partition)
+
+def dropIndexes(conn, prefix=''):
+    with conn.cursor() as cur:
+        lockSchema(cur)
+        for name, table, columns in SECONDARY_INDEXES:
+            cur.execute("DROP INDEX IF EXISTS {0}".format(DBLoader.prefixedTable(name, prefix)))
+    conn.commit()
+    log.info("Dropped the secondary indexes")
+
+def createIndexes(conn, prefix=''):
+    with conn.cursor() as cur:
+        lockSchema(cur)
+        for name, table, columns in SECONDARY_INDEXES:
+            name = DBLoader.prefixedTable(name, prefix)
+            log.info("Building %s...", name)
+            cur.execute("CREATE INDEX IF NOT EXISTS {0} ON {1} ({2})".format(
+                name.split('.')[-1], DBLoader.prefixedTable(table, prefix), columns))
+    conn.commit()
+
+if __name__ == '__main__':
+    main()
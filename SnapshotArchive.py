@@ -0,0 +1,174 @@
+"""
+Compact container for raw GTFS-RT snapshots.
+
+A file starts with a 16 bytes header (magic and compression codec), followed
+by one record per snapshot: a small header (compressed length, feed type,
+feed timestamp, raw length) and the compressed protobuf bytes. Each snapshot
+is compressed on its own, so any of them can be read without decompressing
+the others. When the writer is closed, an index of every record and a footer
+pointing to it are appended; files left without one (e.g. after a crash) are
+indexed by scanning the record headers instead.
+"""
+from collections import namedtuple
+from threading import Lock
+import mmap
+import os.path
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+SNAPSHOT_EXTENSION = '.gtfsrt'
+MAGIC = b'GTFSRTA1'
+FOOTER_MAGIC = b'GTFSRTIX'
+HEADER = struct.Struct('<8sB7x')
+RECORD = struct.Struct('<IB3xQI')
+INDEX_ENTRY = struct.Struct('<B3xQQII')
+FOOTER = struct.Struct('<QI8s')
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 10
+
+FEED_TRIP_UPDATES = 1
+FEED_VEHICLE_POSITIONS = 2
+FEED_TYPES = {
+    'tripupdates': FEED_TRIP_UPDATES,
+    'vehiclepositions': FEED_VEHICLE_POSITIONS
+}
+FEED_NAMES = dict((value, name) for name, value in FEED_TYPES.items())
+
+# offset and length locate the compressed bytes of the snapshot in the file
+Entry = namedtuple('Entry', ['feedType', 'timestamp', 'offset', 'length', 'rawLength'])
+
+def defaultCodec():
+    return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+def compress(codec, content):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(content)
+    return zlib.compress(content, ZLIB_LEVEL)
+
+def decompress(codec, content, rawLength):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise Exception('The zstandard package is needed to read this archive')
+        return zstandard.ZstdDecompressor().decompress(content, max_output_size=rawLength)
+    return zlib.decompress(content)
+
+class SnapshotWriter:
+    """
+    Appends snapshots to an archive, safe to share between threads. Opening an
+    existing archive keeps its snapshots and appends after them.
+    """
+    def __init__(self, path, codec=None):
+        self.path = path
+        self.lock = Lock()
+        self.entries = []
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            reader = SnapshotReader(path)
+            self.codec = reader.codec
+            self.entries = list(reader.entries)
+            end = reader.dataEnd
+            reader.close()
+            self.file = open(path, 'r+b')
+            # Drops the old index, rewritten on close
+            self.file.truncate(end)
+            self.file.seek(end)
+        else:
+            self.codec = codec if codec is not None else defaultCodec()
+            self.file = open(path, 'wb')
+            self.file.write(HEADER.pack(MAGIC, self.codec))
+
+    def add(self, feedType, timestamp, content):
+        if isinstance(feedType, str):
+            feedType = FEED_TYPES[feedType]
+        data = compress(self.codec, content)
+        with self.lock:
+            offset = self.file.tell() + RECORD.size
+            self.file.write(RECORD.pack(len(data), feedType, timestamp, len(content)))
+            self.file.write(data)
+            self.file.flush()
+            self.entries.append(Entry(feedType, timestamp, offset, len(data), len(content)))
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            indexOffset = self.file.tell()
+            for entry in self.entries:
+                self.file.write(INDEX_ENTRY.pack(*entry))
+            self.file.write(FOOTER.pack(indexOffset, len(self.entries), FOOTER_MAGIC))
+            self.file.close()
+
+class SnapshotReader:
+    """
+    Random access to the snapshots of an archive. Files are memory-mapped, so
+    only the snapshots actually read are loaded and decompressed. The source
+    is a path or the bytes of an archive.
+    """
+    def __init__(self, source):
+        self.file = None
+        if isinstance(source, str):
+            self.file = open(source, 'rb')
+            self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.data = source
+        magic, self.codec = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise Exception('Not a snapshot archive')
+        self.entries, self.dataEnd = self._readIndex()
+
+    def _readIndex(self):
+        if len(self.data) >= HEADER.size + FOOTER.size:
+            indexOffset, count, magic = FOOTER.unpack_from(self.data, len(self.data) - FOOTER.size)
+            if magic == FOOTER_MAGIC:
+                entries = [Entry(*INDEX_ENTRY.unpack_from(self.data, indexOffset + i * INDEX_ENTRY.size))
+                    for i in range(count)]
+                return entries, indexOffset
+        # No index: the writer did not close the file. Every complete record
+        # is kept, a truncated last one is ignored.
+        entries = []
+        position = HEADER.size
+        while position + RECORD.size <= len(self.data):
+            length, feedType, timestamp, rawLength = RECORD.unpack_from(self.data, position)
+            offset = position + RECORD.size
+            if offset + length > len(self.data):
+                break
+            entries.append(Entry(feedType, timestamp, offset, length, rawLength))
+            position = offset + length
+        return entries, position
+
+    def find(self, feedType=None, start=None, end=None):
+        """
+        Entries of the given feed type (name or code) with a timestamp in
+        [start, end), in the order they were written.
+        """
+        if isinstance(feedType, str):
+            feedType = FEED_TYPES[feedType]
+        return [entry for entry in self.entries
+            if (feedType is None or entry.feedType == feedType)
+            and (start is None or entry.timestamp >= start)
+            and (end is None or entry.timestamp < end)]
+
+    def read(self, entry):
+        """Raw protobuf bytes of one snapshot."""
+        return decompress(self.codec, self.data[entry.offset:entry.offset + entry.length],
+            entry.rawLength)
+
+    def snapshots(self, feedType=None, start=None, end=None):
+        for entry in self.find(feedType, start, end):
+            yield (entry, self.read(entry))
+
+    def close(self):
+        if self.file is not None:
+            self.data.close()
+            self.file.close()
+
+def snapshotName(entry):
+    """File-like name of a snapshot, e.g. tripupdates_1550000000."""
+    return "{0}_{1}".format(FEED_NAMES.get(entry.feedType, 'unknown'), entry.timestamp)
@@ -0,0 +1,229 @@
+"""
+Reference cache of the static GTFS feed, used to link the stop time updates
+to their scheduled stop time and to flag IDs the schedule does not know,
+without any database lookup.
+
+The trips.txt and stop_times.txt tables of the GTFS zip are compiled once
+into an index file: the trip, route and stop IDs, then int32 arrays of the
+stop times grouped by trip and sorted by stop_sequence. The file is opened
+with mmap, so the backfill processes share the same pages; each process only
+builds a dict from trip_id to its position. The index is rebuilt when the
+GTFS zip changes.
+
+    python StaticGtfs.py gtfs_stm.zip    builds the index of a GTFS zip
+"""
+from array import array
+from collections import namedtuple
+import argparse
+import bisect
+import csv
+import io
+import logging
+import mmap
+import os
+import struct
+import zipfile
+import Metrics
+
+CONFIG_SECTION_GTFS = 'gtfs'
+GTFS_DEFAULTS = {
+    # Static GTFS zip, empty to disable the cache
+    'path': '',
+    # Index file, <path>.idx if empty
+    'index': ''
+}
+INDEX_SUFFIX = '.idx'
+MAGIC = b'GTFSIDX1'
+# magic, size and mtime of the GTFS zip, then the trip, route, stop and
+# stop time counts and the length of the IDs
+HEADER = struct.Struct('<8sQqIIIIQ')
+INT32 = 'i'
+
+log = logging.getLogger(__name__)
+
+Trip = namedtuple('Trip', ['routeId', 'start', 'end'])
+
+class StaticGtfs:
+    """
+    Read-only view of an index file. stopTimeId numbers the stop times in the
+    order of stop_times.txt, from 1.
+    """
+    def __init__(self, indexPath):
+        self.file = open(indexPath, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        header = HEADER.unpack_from(view)
+        if header[0] != MAGIC:
+            raise Exception('{0} is not a static GTFS index'.format(indexPath))
+        self.source = header[1:3]
+        tripCount, routeCount, stopCount, stopTimeCount, idsLength = header[3:]
+        offset = HEADER.size
+        arrays = []
+        for length in (tripCount, tripCount + 1, stopTimeCount, stopTimeCount, stopTimeCount):
+            end = offset + 4 * length
+            arrays.append(view[offset:end].cast(INT32))
+            offset = end
+        self.tripRoutes, self.tripStarts, self.sequences, self.stops, self.stopTimeIds = arrays
+        ids = bytes(view[offset:offset + idsLength]).decode('utf-8').split('\n')
+        self.tripIds = dict((tripId, index) for index, tripId in enumerate(ids[:tripCount]))
+        self.routeIds = ids[tripCount:tripCount + routeCount]
+        self.stopIds = ids[tripCount + routeCount:]
+
+    def trip(self, tripId, routeId=None):
+        """
+        The scheduled trip, or None when tripId is not in the schedule. A
+        route_id other than the scheduled one is counted, but still accepted.
+        """
+        index = self.tripIds.get(tripId)
+        if index is None:
+            Metrics.increment('unknown_ids_total', id='trip')
+            return None
+        scheduledRoute = self.routeIds[self.tripRoutes[index]]
+        if routeId is not None and routeId != scheduledRoute:
+            Metrics.increment('unknown_ids_total', id='route')
+        return Trip(scheduledRoute, self.tripStarts[index], self.tripStarts[index + 1])
+
+    def stopTimeId(self, trip, stopSequence, stopId=None):
+        """
+        stop_time_id of a stop of a trip returned by trip(), or None when the
+        schedule has no such stop_sequence or another stop at it.
+        """
+        if trip is None:
+            return None
+        # stop_sequence usually counts from 1 without gaps
+        position = trip.start + stopSequence - 1
+        if not (trip.start <= position < trip.end and self.sequences[position] == stopSequence):
+            position = bisect.bisect_left(self.sequences, stopSequence, trip.start, trip.end)
+            if position == trip.end or self.sequences[position] != stopSequence:
+                Metrics.increment('unknown_ids_total', id='stop_sequence')
+                return None
+        if stopId is not None and self.stopIds[self.stops[position]] != stopId:
+            Metrics.increment('unknown_ids_total', id='stop')
+            return None
+        return self.stopTimeIds[position]
+
+    def close(self):
+        self.tripRoutes.release()
+        self.tripStarts.release()
+        self.sequences.release()
+        self.stops.release()
+        self.stopTimeIds.release()
+        self.map.close()
+        self.file.close()
+
+def indexPathOf(gtfsConfig):
+    return gtfsConfig['index'] or gtfsConfig['path'] + INDEX_SUFFIX
+
+def load(gtfsConfig):
+    """
+    Opens the index of the configured GTFS zip, building it first if it is
+    missing or older than the zip. None when no zip is configured.
+    """
+    if not gtfsConfig['path']:
+        return None
+    indexPath = indexPathOf(gtfsConfig)
+    if not isIndexCurrent(gtfsConfig['path'], indexPath):
+        buildIndex(gtfsConfig['path'], indexPath)
+    return StaticGtfs(indexPath)
+
+def sourceStamp(gtfsPath):
+    stat = os.stat(gtfsPath)
+    return (stat.st_size, stat.st_mtime_ns)
+
+def isIndexCurrent(gtfsPath, indexPath):
+    if not os.path.exists(indexPath):
+        return False
+    with open(indexPath, 'rb') as f:
+        header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return False
+    header = HEADER.unpack(header)
+    return header[0] == MAGIC and header[1:3] == sourceStamp(gtfsPath)
+
+def readTable(zip_ref, name, columns):
+    """Yields the given columns of each row of a GTFS table."""
+    # utf-8-sig drops the byte order mark some agencies start their files with
+    with zip_ref.open(name) as f:
+        reader = csv.reader(io.TextIOWrapper(f, encoding='utf-8-sig', newline=''))
+        header = next(reader)
+        positions = [header.index(column) for column in columns]
+        for row in reader:
+            if row:
+                yield [row[position] for position in positions]
+
+def buildIndex(gtfsPath, indexPath):
+    """
+    Compiles trips.txt and stop_times.txt into an index file. Stop times are
+    kept in int32 arrays and grouped by trip with a counting sort, so even a
+    schedule of millions of stop times is indexed without a tuple per row.
+    """
+    with Metrics.timed('gtfs_index'), zipfile.ZipFile(gtfsPath, 'r') as zip_ref:
+        tripIds = {}
+        routeIds = {}
+        tripRoutes = array(INT32)
+        for tripId, routeId in readTable(zip_ref, 'trips.txt', ('trip_id', 'route_id')):
+            if tripId in tripIds:
+                continue
+            tripIds[tripId] = len(tripIds)
+            tripRoutes.append(routeIds.setdefault(routeId, len(routeIds)))
+        stopIds = {}
+        trips = array(INT32)
+        sequences = array(INT32)
+        stops = array(INT32)
+        for tripId, stopId, stopSequence in readTable(zip_ref, 'stop_times.txt',
+                ('trip_id', 'stop_id', 'stop_sequence')):
+            # Trips missing from trips.txt are still counted, so stop_time_id
+            # stays the row number
+            trips.append(tripIds.get(tripId, -1))
+            sequences.append(int(stopSequence))
+            stops.append(stopIds.setdefault(stopId, len(stopIds)))
+    tripStarts = array(INT32, [0]) * (len(tripIds) + 1)
+    for trip in trips:
+        if trip >= 0:
+            tripStarts[trip + 1] += 1
+    for index in range(len(tripIds)):
+        tripStarts[index + 1] += tripStarts[index]
+    stopTimeCount = tripStarts[-1]
+    nextPosition = array(INT32, tripStarts[:-1])
+    sortedSequences = array(INT32, [0]) * stopTimeCount
+    sortedStops = array(INT32, [0]) * stopTimeCount
+    stopTimeIds = array(INT32, [0]) * stopTimeCount
+    for row, trip in enumerate(trips):
+        if trip < 0:
+            continue
+        position = nextPosition[trip]
+        nextPosition[trip] += 1
+        sortedSequences[position] = sequences[row]
+        sortedStops[position] = stops[row]
+        stopTimeIds[position] = row + 1
+    for trip in range(len(tripIds)):
+        sortTrip(tripStarts[trip], tripStarts[trip + 1], sortedSequences, sortedStops, stopTimeIds)
+    ids = '\n'.join(list(tripIds) + list(routeIds) + list(stopIds)).encode('utf-8')
+    with open(indexPath + '.tmp', 'wb') as f:
+        f.write(HEADER.pack(MAGIC, *sourceStamp(gtfsPath), len(tripIds), len(routeIds),
+            len(stopIds), stopTimeCount, len(ids)))
+        # In native byte order: the index is a local cache of the zip
+        for values in (tripRoutes, tripStarts, sortedSequences, sortedStops, stopTimeIds):
+            values.tofile(f)
+        f.write(ids)
+    os.replace(indexPath + '.tmp', indexPath)
+    log.info("Indexed %d trips and %d stop times of %s", len(tripIds), stopTimeCount, gtfsPath)
+
+def sortTrip(start, end, sequences, stops, stopTimeIds):
+    # stop_times.txt is almost always sorted already
+    if all(sequences[i] < sequences[i + 1] for i in range(start, end - 1)):
+        return
+    order = sorted(range(start, end), key=sequences.__getitem__)
+    for values in (sequences, stops, stopTimeIds):
+        values[start:end] = array(INT32, [values[i] for i in order])
+
+def main():
+    parser = argparse.ArgumentParser(description="Builds the index of a static GTFS zip.")
+    parser.add_argument('path', help="GTFS zip")
+    parser.add_argument('--index', default='', help="index file, <path>.idx by default")
+    args = parser.parse_args()
+    Metrics.setupLogging('INFO')
+    buildIndex(args.path, indexPathOf({'path': args.path, 'index': args.index}))
+
+if __name__ == '__main__':
+    main()
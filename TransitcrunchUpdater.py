@@ -1,284 +1,398 @@
-from __future__ import print_function
-from psycopg2 import extras
 from datetime import datetime
-from datetime import timedelta
-from threading import Thread
-from configparser import ConfigParser
-from google.protobuf import json_format
-from google.transit import gtfs_realtime_pb2
-import psycopg2
-import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+import Columnar
+import Config
+import DBLoader
+import Dedup
+import FeedRegistry
+import Ingestion
+import Metrics
+import Schema
+import SnapshotArchive
+import StaticGtfs
+import WriteBehind
+import argparse
+import asyncio
+import logging
+import requests
 import os.path
-import json
-import urllib.request
 
 BASE_STM_URL = 'https://api.stm.info/pub/od/gtfs-rt/ic/v1'
 BASE_RTM_URL = 'http://opendata.amt.qc.ca:2539/ServiceGTFSR'
 STM_GTFS_TRIP_UPDATE_URL = '%s/tripUpdates' % (BASE_STM_URL)
 STM_GTFS_VEHICLE_POSITION_URL = '%s/vehiclePositions' % (BASE_STM_URL)
+RTM_GTFS_TRIP_UPDATE_URL = '%s/TripUpdate.pb' % (BASE_RTM_URL)
+RTM_GTFS_VEHICLE_POSITION_URL = '%s/VehiclePosition.pb' % (BASE_RTM_URL)
 
-CONFIG_FILENAME = "database.ini"
+CONFIG_FILENAME = Config.CONFIG_FILENAME
 CONFIG_SECTION_POSTGRES = 'postgresql'
 CONFIG_SECTION_APIS = 'apikeys'
 CONFIG_STM_API_KEY = 'stmapikey'
-#CONFIG_RTM_API_KEY = 'rtmapikey'
+CONFIG_RTM_API_KEY = 'rtmapikey'
+CONFIG_SECTION_POLLER = 'poller'
+POLLER_DEFAULTS = {
+    # Seconds between the start of two polls of a feed with --poll, unless
+    # its [feed:<name>] section sets another interval
+    'interval': 30.0,
+    # Seconds before a feed request is abandoned
+    'timeout': 20.0,
+    # Requests running at once to the same host
+    'perhost': 4,
+    # Without [feed:<name>] sections, also fetch the RTM feeds, archived to
+    # RTM_downloads/ but not inserted
+    'rtm': False,
+    # Keep the raw protobuf of every STM snapshot under rawpath, either in
+    # one snapshot archive per day ("snapshot") or as loose .pb files ("pb")
+    'keepraw': False,
+    'rawpath': 'archive',
+    'rawformat': 'snapshot'
+}
+DOWNLOAD_PATH = 'downloads'
+RTM_DOWNLOAD_PATH = 'RTM_downloads'
+# Files are written under this suffix first and renamed once complete, so
+# nothing ever reads a half-written file.
+TEMP_SUFFIX = '.tmp'
+# Snapshots decompressed at once when replaying an archive
+SNAPSHOT_BATCH_SIZE = 16
 
-class Downloader(Thread):
-    def __init__(self, endpoint, apikey, dir_path, filename):
-        Thread.__init__(self)
-        self.endpoint = endpoint
-        self.apikey = apikey
-        self.filename = filename
-        self.path = dir_path
+SnapshotWriters = {}
+SnapshotWritersLock = Lock()
+PartitionsCheckedOn = None
+# Target of each table prefix
+Targets = {}
 
-    def run(self):
-        data = ()
-        headers = {'apikey': self.apikey}
-        req = urllib.request.Request(self.endpoint, data, headers)
-        api_response = urllib.request.urlopen(req)
-        response_feed = gtfs_realtime_pb2.FeedMessage()
-        response_feed.ParseFromString(api_response.read())
-        json_string = json_format.MessageToJson(response_feed)
-        response_timestamp = response_feed.header.timestamp
-        file_name = self.filename+"_"+str(response_timestamp)+".json"
-        file = open( os.path.join(self.path, file_name), "w+")
-        file.write(json_string)
-        file.close()
+log = logging.getLogger(__name__)
 
-class RTM_downloader(Thread):
-    def __init__(self, endpoint, dir_path, filename):
-        Thread.__init__(self)
-        self.endpoint = endpoint
-        self.filename = filename
-        self.path = dir_path
-    
-    def run(self):
-        req = urllib.request.Request(self.endpoint)
-        api_response = urllib.request.urlopen(req)
-        response_feed = gtfs_realtime_pb2.FeedMessage()
-        response_feed.ParseFromString(api_response.read())
-        json_string = json_format.MessageToJson(response_feed)
-        response_timestamp = response_feed.header.timestamp
-        file_name = self.filename+"_"+str(response_timestamp)+".json"
-
-        file = open(os.path.join(self.path, file_name), "w+")
-        file.write(json_string)
-        file.close()
+class Target:
+    """
+    The tables of a table prefix, with their own deduplication caches and
+    write-behind buffer, since the trips of two agencies are unrelated.
+    """
+    def __init__(self, prefix, dedupConfig, staticGtfs=None):
+        self.prefix = prefix
+        self.snapshotDedup, self.tripDedup = Dedup.createDeduplicators(dedupConfig)
+        self.staticGtfs = staticGtfs
+        self.writeBehind = None
 
 def main():
-    global StmApiConfig
-    StmApiConfig = readConfig(CONFIG_SECTION_APIS, CONFIG_FILENAME)
+    parser = argparse.ArgumentParser(
+        description="Downloads the GTFS-RT feeds and inserts them in the database.")
+    parser.add_argument('--poll', action='store_true',
+        help="keep polling the feeds every [poller] interval instead of running once")
+    args = parser.parse_args()
+
+    global MetricsConfig
+    MetricsConfig = Config.readConfig(Metrics.CONFIG_SECTION_METRICS, CONFIG_FILENAME,
+        Metrics.METRICS_DEFAULTS)
+    Metrics.start(MetricsConfig)
     global PostGresConfig
-    PostGresConfig = readConfig(CONFIG_SECTION_POSTGRES, CONFIG_FILENAME)
+    PostGresConfig = Config.readConfig(CONFIG_SECTION_POSTGRES, CONFIG_FILENAME)
+    global LoaderConfig
+    LoaderConfig = Config.readConfig(DBLoader.CONFIG_SECTION_LOADER, CONFIG_FILENAME,
+        DBLoader.LOADER_DEFAULTS)
+    global DBPool
+    DBPool = DBLoader.ConnectionPool(PostGresConfig, LoaderConfig['poolsize'])
+    global TripUpdateIds
+    TripUpdateIds = DBLoader.IdAllocator(LoaderConfig['idblocksize'])
+    global ParquetExport
+    ParquetExport = Columnar.createExport(
+        Config.readConfig(Columnar.CONFIG_SECTION_PARQUET, CONFIG_FILENAME, Columnar.PARQUET_DEFAULTS))
+    global StaticFeed
+    StaticFeed = StaticGtfs.load(
+        Config.readConfig(StaticGtfs.CONFIG_SECTION_GTFS, CONFIG_FILENAME, StaticGtfs.GTFS_DEFAULTS))
+    dedupConfig = Config.readConfig(Dedup.CONFIG_SECTION_DEDUP, CONFIG_FILENAME, Dedup.DEDUP_DEFAULTS)
+    global PollerConfig
+    PollerConfig = Config.readConfig(CONFIG_SECTION_POLLER, CONFIG_FILENAME, POLLER_DEFAULTS)
+    global SchemaConfig
+    SchemaConfig = Config.readConfig(Schema.CONFIG_SECTION_SCHEMA, CONFIG_FILENAME, Schema.SCHEMA_DEFAULTS)
+    writeBehindConfig = Config.readConfig(WriteBehind.CONFIG_SECTION_WRITE_BEHIND, CONFIG_FILENAME,
+        WriteBehind.WRITE_BEHIND_DEFAULTS)
+
+    feeds = getFeeds()
+    for feed in feeds:
+        if feed.rawPath is not None and not os.path.exists(feed.rawPath):
+            os.makedirs(feed.rawPath)
+    # The default tables are always set up, for the files in downloads/.
+    # The static GTFS is the schedule of the agency of the default tables.
+    for prefix in [''] + [feed.tablePrefix for feed in feeds if feed.ingest]:
+        if prefix not in Targets:
+            Targets[prefix] = Target(prefix, dedupConfig, None if prefix else StaticFeed)
+
+    session = createSession(len(feeds))
+    try:
+        ensurePartitions()
+        # On a connection of its own, since it commits
+        with DBPool.transaction() as conn:
+            TripUpdateIds.prepare(conn)
+        # Rows left in the journals by a previous run are inserted first
+        for target in Targets.values():
+            target.writeBehind = WriteBehind.createWriteBehind(writeBehindConfig, DBPool,
+                TripUpdateIds, LoaderConfig['mode'], LoaderConfig['latest'], ParquetExport,
+                target.prefix)
+        # JSON files left in downloads/ by earlier versions, or snapshot
+        # archives dropped there to be replayed
+        if os.path.exists(DOWNLOAD_PATH):
+            processFiles(DOWNLOAD_PATH)
+        scheduler = FeedRegistry.FeedScheduler(feeds, PollerConfig['perhost'])
+        if args.poll:
+            asyncio.run(pollForever(session, scheduler))
+        else:
+            ingestSnapshots(asyncio.run(fetchFeeds(session, feeds, scheduler)))
+    except KeyboardInterrupt:
+        log.info('Polling stopped')
+    finally:
+        session.close()
+        closeSnapshotWriters()
+        for target in Targets.values():
+            if target.writeBehind is not None:
+                target.writeBehind.close()
+        DBPool.close()
+        Metrics.reportSummary(MetricsConfig['summary'])
+
+def getFeeds():
+    rawPath = PollerConfig['rawpath'] if PollerConfig['keepraw'] else None
+    feeds = FeedRegistry.readFeeds(CONFIG_FILENAME, PollerConfig['interval'], rawPath)
+    if feeds:
+        return feeds
+    # Without a registry, the STM feeds and, with rtm, the RTM ones
+    apiConfig = Config.readConfig(CONFIG_SECTION_APIS, CONFIG_FILENAME)
+    stmFeed = dict(FeedRegistry.FEED_DEFAULTS, auth=FeedRegistry.AUTH_HEADER, authname='apikey',
+        apikey=apiConfig[CONFIG_STM_API_KEY])
+    feedConfigs = [
+        ('stm-tripupdates', dict(stmFeed, url=STM_GTFS_TRIP_UPDATE_URL, type='tripupdates')),
+        ('stm-vehiclepositions', dict(stmFeed, url=STM_GTFS_VEHICLE_POSITION_URL, type='vehiclepositions'))
+    ]
+    if PollerConfig['rtm']:
+        rtmFeed = dict(FeedRegistry.FEED_DEFAULTS, auth=FeedRegistry.AUTH_QUERY, authname='token',
+            apikey=apiConfig[CONFIG_RTM_API_KEY], ingest=False, rawpath=RTM_DOWNLOAD_PATH)
+        feedConfigs.append(('rtm-tripupdates',
+            dict(rtmFeed, url=RTM_GTFS_TRIP_UPDATE_URL, type='tripupdates')))
+        feedConfigs.append(('rtm-vehiclepositions',
+            dict(rtmFeed, url=RTM_GTFS_VEHICLE_POSITION_URL, type='vehiclepositions')))
+    return [FeedRegistry.createFeed(name, feedConfig, PollerConfig['interval'], rawPath)
+        for name, feedConfig in feedConfigs]
+
+def createSession(connections):
+    # One keep-alive session for every poll, so the TCP and TLS handshakes
+    # are only paid once per host.
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=connections, pool_maxsize=connections)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+async def pollForever(session, scheduler):
+    """
+    Fetches the feeds as they are due, concurrently. Inserting the snapshots
+    runs as a background task on a single thread, so a slow database never
+    delays the next poll and snapshots are still inserted in order.
+    """
+    loop = asyncio.get_event_loop()
+    ingestExecutor = ThreadPoolExecutor(max_workers=1)
+    ingestion = None
+    while True:
+        snapshots = await fetchFeeds(session, scheduler.due(loop.time()), scheduler)
+        if snapshots:
+            if ingestion is not None and not ingestion.done():
+                # The database is behind: polls slow down rather than queueing
+                # snapshots in memory
+                log.warning("Waiting for the previous snapshots to be ingested")
+                await asyncio.wait([ingestion])
+            ingestion = loop.run_in_executor(ingestExecutor, ingestSnapshots, snapshots)
+            ingestion.add_done_callback(reportIngestion)
+        await asyncio.sleep(scheduler.delay(loop.time()))
+
+async def fetchFeeds(session, feeds, scheduler):
+    log.info('Downloads started')
+    results = await asyncio.gather(
+        *[fetchWithinLimit(session, feed, scheduler) for feed in feeds],
+        return_exceptions=True)
+    snapshots = []
+    for feed, result in zip(feeds, results):
+        if isinstance(result, Exception):
+            log.error("Download of %s failed: %s", feed.name, result)
+            Metrics.increment('downloads_failed_total')
+        elif result is not None and feed.ingest:
+            snapshots.append(result)
+    log.info('Downloads completed')
+    return snapshots
+
+async def fetchWithinLimit(session, feed, scheduler):
+    loop = asyncio.get_event_loop()
+    async with scheduler.hostLimit(feed):
+        return await loop.run_in_executor(None, fetchFeed, session, feed)
+
+def fetchFeed(session, feed):
+    """
+    Downloads and parses a feed, or returns None when the server answers
+    that it did not change since the last response.
+    """
+    with Metrics.timed('download'):
+        response = session.get(feed.url, headers=feed.requestHeaders(), params=feed.params,
+            timeout=PollerConfig['timeout'])
+        if response.status_code == requests.codes.not_modified:
+            Metrics.increment('feeds_unchanged_total', feed=feed.name)
+            return None
+        response.raise_for_status()
+    Metrics.increment('bytes_downloaded_total', len(response.content))
+    with Metrics.timed('parse'):
+        response_feed = Ingestion.parseFeed(response.content)
+    response_timestamp = response_feed.header.timestamp
+    name = feed.feedType+"_"+str(response_timestamp)
+    if feed.rawPath is not None:
+        archiveRaw(feed, name, response_timestamp, response.content)
+    # Only once the snapshot is parsed, so a bad one is downloaded again
+    feed.remember(response)
+    return (name, response_feed, Dedup.contentHash(response.content), feed.tablePrefix)
+
+def archiveRaw(feed, name, timestamp, content):
+    # The raw protobuf is 5-10x smaller than its JSON, and compresses well
+    if PollerConfig['rawformat'] == 'pb':
+        filePath = os.path.join(feed.rawPath, name + ".pb")
+        with open(filePath + TEMP_SUFFIX, "wb") as file:
+            file.write(content)
+        os.replace(filePath + TEMP_SUFFIX, filePath)
+    else:
+        getSnapshotWriter(feed.rawPath).add(feed.feedType, timestamp, content)
+
+def getSnapshotWriter(path):
+    # One archive per folder and per UTC day, e.g. snapshots_2019-02-01.gtfsrt
+    day = datetime.utcnow().strftime('%Y-%m-%d')
+    with SnapshotWritersLock:
+        current = SnapshotWriters.get(path)
+        if current is None or current[0] != day:
+            if current is not None:
+                current[1].close()
+            fileName = "snapshots_" + day + SnapshotArchive.SNAPSHOT_EXTENSION
+            current = (day, SnapshotArchive.SnapshotWriter(os.path.join(path, fileName)))
+            SnapshotWriters[path] = current
+        return current[1]
 
-    STM_GTFS_API_KEY = StmApiConfig[CONFIG_STM_API_KEY]
-    #RTM_TOKEN = StmApiConfig[CONFIG_RTM_API_KEY]
-    #RTM_GTFS_TRIP_UPDATE_URL = '%s/TripUpdate.pb?token=%s' % (BASE_RTM_URL, RTM_TOKEN)
-    #RTM_GTFS_VEHICLE_POSITION_URL = '%s/VehiclePosition.pb?token=%s' % (BASE_RTM_URL, RTM_TOKEN)
+def closeSnapshotWriters():
+    with SnapshotWritersLock:
+        for day, writer in SnapshotWriters.values():
+            writer.close()
+        SnapshotWriters.clear()
 
-    path='downloads'
-    #RTM_path='RTM_downloads'
-    
-    ### STM
-    if not os.path.exists(path):
-        os.makedirs(path)
-    downloader_1 = Downloader(STM_GTFS_TRIP_UPDATE_URL, STM_GTFS_API_KEY, 'downloads', 'tripupdates')
-    downloader_2 = Downloader(STM_GTFS_VEHICLE_POSITION_URL, STM_GTFS_API_KEY, 'downloads', 'vehiclepositions')
-    #downloader_3 = RTM_downloader(RTM_GTFS_TRIP_UPDATE_URL, 'RTM_downloads', 'tripupdates')
-    #downloader_4 = RTM_downloader(RTM_GTFS_VEHICLE_POSITION_URL, 'RTM_downloads', 'vehiclepositions')
+def ensurePartitions():
+    # Checked once a day, so a poller running for months keeps creating the
+    # partitions of the coming months.
+    global PartitionsCheckedOn
+    today = datetime.utcnow().date()
+    if PartitionsCheckedOn == today:
+        return
+    with DBPool.transaction() as conn:
+        for prefix in Targets:
+            # The tables of a new table prefix are created on its first run
+            if prefix and Schema.createTables(conn, prefix):
+                Schema.createIndexes(conn, prefix)
+            Schema.ensureFuturePartitions(conn, SchemaConfig['partitionsahead'], prefix)
+            Schema.addColumns(conn, prefix)
+            if LoaderConfig['latest']:
+                Schema.createLatestTables(conn, prefix)
+    PartitionsCheckedOn = today
 
-    print('STM downloads started')
-    downloader_1.start()
-    downloader_1.join()
-    downloader_2.start()
-    downloader_2.join()
-    print('STM downloads completed')
-    
-    ### RTM
-    #if not os.path.exists(RTM_path):
-    #    os.makedirs(RTM_path)
-    #print('RTM downloads started')
-    #downloader_3.start()
-    #downloader_3.join()
-    #downloader_4.start()
-    #downloader_4.join()
-    #print('RTM downloads completed')
-    
-    processFiles(path)
+def ingestSnapshots(snapshots):
+    ensurePartitions()
+    for name, feed, digest, prefix in snapshots:
+        target = Targets[prefix]
+        if target.snapshotDedup is not None and not target.snapshotDedup.claimFeed(name, feed, digest):
+            log.info("Skipping %s, already inserted.", name)
+            Metrics.increment('feeds_skipped_total')
+            continue
+        try:
+            if target.writeBehind is not None:
+                if (bufferFeed(name, feed, target)): log.info("Buffered %s.", name)
+            else:
+                with dedupTransaction(target) as conn:
+                    success = insertFeed(name, feed, conn, target)
+                if (success): log.info("Inserted %s successfully in database.", name)
+        except Exception:
+            # Not inserted, so the next copy of the snapshot is
+            if target.snapshotDedup is not None:
+                target.snapshotDedup.forgetFeed(name, feed, digest)
+            raise
 
-def readConfig(section, filename=CONFIG_FILENAME):
-    parser = ConfigParser()
-    parser.read(filename)
-    sectionParams = {}
-    if parser.has_section(section):
-        params = parser.items(section)
-        for param in params:
-            sectionParams[param[0]] = param[1]
+def bufferFeed(name, feed, target):
+    # Rows are journaled once buffered, so the trip cache can remember them
+    # right away.
+    feedType = Ingestion.feedTypeOf(name)
+    if feedType == "tripupdates":
+        trips = list(Ingestion.tripUpdateRows(feed, target.staticGtfs))
+        if target.tripDedup is not None:
+            target.tripDedup.resize(len(trips))
+        target.writeBehind.add(Ingestion.filterChangedTrips(trips, target.tripDedup), [])
+    elif feedType == "vehiclepositions":
+        target.writeBehind.add([], list(Ingestion.vehiclePositionRows(feed)))
     else:
-        raise Exception('Section {0} not found in the {1} file'.format(section, filename))
-    return sectionParams
+        return False
+    return True
+
+@contextmanager
+def dedupTransaction(target):
+    # The trip cache is filled before the commit; if the transaction fails
+    # it is emptied so the next feeds insert those trips again.
+    try:
+        with DBPool.transaction() as conn:
+            yield conn
+    except Exception:
+        if target.tripDedup is not None:
+            target.tripDedup.clear()
+        raise
+
+def reportIngestion(future):
+    if future.exception() is not None:
+        log.error("Ingestion failed: %s", future.exception())
 
 def processFiles(path):
     filesList = os.listdir(path)
     for file in filesList:
         filePath = os.path.join(path, file)
+        if file.endswith(SnapshotArchive.SNAPSHOT_EXTENSION):
+            processSnapshotArchive(filePath)
+            os.remove(filePath)
+            continue
         data = parseJson(filePath)
-        if "tripupdates" in file:
-            success = insertTripUpdatesInDB(data)
-            if (success): print("Inserted " + file + " successfully in database.")
-        elif "vehiclepositions" in file:
-            success = insertVehiclePositionsInDB(data)
-            if (success): print("Inserted " + file + " successfully in database.")
+        with dedupTransaction(Targets['']) as conn:
+            success = insertFeed(file, data, conn, Targets[''])
+        if (success): log.info("Inserted %s successfully in database.", file)
         os.remove(filePath)
-    print('')
-
-def parseJson(file):
-    print("Parsing {0}".format(os.path.basename(file)))
-    data = None
-    with open(file) as j:
-        data = json.load(j)
-    return data
 
-def insertTripUpdatesInDB(jsonData):
-    if "entity" not in jsonData:
-        return False
-    conn = None
-    # Get the last trip_update ID in the DB
-    queryGetLastId = """
-        SELECT MAX(trip_update_id) FROM public.trip_update
-    """
-    lastId = 0
-    with psycopg2.connect(**PostGresConfig) as conn:
-        with conn.cursor() as cur:
-            cur.execute(queryGetLastId)
-            lastId = cur.fetchone()[0]
-    if lastId is None:
-        lastId = 0
-    
-    # Insertion queries
-    queryTripUpdate = """
-        INSERT INTO public.trip_update
-            (trip_update_id,
-            trip_id,
-            start_time,
-            route_id,
-            created_at)
-        VALUES %s
-    """
-    queryStopTimeUpdate = """
-        INSERT INTO public.stop_time_update
-            (stop_id, 
-            stop_sequence, 
-            trip_update_id, 
-            departure_time, 
-            arrival_time, 
-            schedule_relationship,
-            created_at)
-        VALUES %s
-    """
+def processSnapshotArchive(file):
+    reader = SnapshotArchive.SnapshotReader(file)
+    try:
+        snapshots = []
+        for entry, content in reader.snapshots():
+            snapshots.append((SnapshotArchive.snapshotName(entry), Ingestion.parseFeed(content),
+                Dedup.contentHash(content), ''))
+            if len(snapshots) == SNAPSHOT_BATCH_SIZE:
+                ingestSnapshots(snapshots)
+                snapshots = []
+        ingestSnapshots(snapshots)
+    finally:
+        reader.close()
 
-    # JSON parsing
-    paramsTripUpdate = []
-    paramsStopUpdate = []
-    for en in jsonData["entity"]:
-        tripUp = en['tripUpdate']
-        if tripUp["stopTimeUpdate"][0]['scheduleRelationship'] == 'NO_DATA':
-            #print('Skipping trip ' + tripUp['trip']['tripId'] + " because no StopTimeUpdate data was found.")
-            continue
-        lastId += 1
-        timestamp = None
-        if 'timestamp' in tripUp:
-            timestamp = datetime.utcfromtimestamp(int(tripUp['timestamp']))
-        else:
-            timestamp = None
-        tripUpdate = (
-            lastId,
-            tripUp['trip']['tripId'],
-            tripUp['trip']['startDate'] + ' ' + tripUp['trip']['startTime'],
-            tripUp['trip']['routeId'],
-            timestamp
-        )
-        paramsTripUpdate.append(tripUpdate)
-        for stopTimeUpdate in tripUp["stopTimeUpdate"]:
-            departureTime = None
-            arrivalTime = None
-            if 'departure' in stopTimeUpdate:
-                departureTime = datetime.utcfromtimestamp(int(stopTimeUpdate['departure']['time']))
-            else:
-                departureTime = None
-            if 'arrival' in stopTimeUpdate:
-                arrivalTime = datetime.utcfromtimestamp(int(stopTimeUpdate['arrival']['time']))
-            else:
-                arrivalTime = None
-            stopUpdate = (
-                stopTimeUpdate['stopId'],
-                stopTimeUpdate['stopSequence'],
-                lastId,
-                departureTime,
-                arrivalTime,
-                stopTimeUpdate['scheduleRelationship'],
-                timestamp
-                #TODO stop_time_id
-            )
-            paramsStopUpdate.append(stopUpdate)
-            
-    # Bulk insertion in database
-    with psycopg2.connect(**PostGresConfig) as conn:
-        
-        with conn.cursor() as cur:
-            #cur.execute(queryTripUpdate, paramsTripUpdate)
-            #tripUpdateId = cur.fetchone()[0] # Fetch the ID that is returned by the DB
-            #cur.execute(queryStopTimeUpdate, paramsStopUpdate)
-            print('Inserting TripUpdate...')
-            psycopg2.extras.execute_values(cur, queryTripUpdate, paramsTripUpdate, page_size=200)
-            print('Inserting StopTimeUpdate...')
-            psycopg2.extras.execute_values(cur, queryStopTimeUpdate, paramsStopUpdate, page_size=200)
-            return True
-    return False
+def parseJson(file):
+    log.debug("Parsing %s", os.path.basename(file))
+    with open(file, 'rb') as j, Metrics.timed('parse'):
+        return Ingestion.JsonFeed(j.read())
 
-def insertVehiclePositionsInDB(jsonData):
-    if "entity" not in jsonData:
-        return False
-    conn = None
-    #queryVehicle = """
-    #    INSERT INTO public.vehicle
-    #        (vehicle_id)
-    #    VALUES %s
-    #    ON CONFLICT DO NOTHING
-    #"""
-    queryVehiclePositions = """
-        INSERT INTO public.vehicle_position
-            (vehicle_id, 
-            trip_id, 
-            current_stop_sequence, 
-            current_status, 
-            vehicle_lat, 
-            vehicle_lon, 
-            created_at)
-        VALUES %s
-    """
-    with psycopg2.connect(**PostGresConfig) as conn:
-        paramsVehicle = []
-        data_list = []
-        for en in jsonData["entity"]: 
-            vehicle = en['vehicle']
-            paramsVehicle.append(vehicle['vehicle']['id'])
-            data = (
-                vehicle['vehicle']['id'],
-                vehicle['trip']['tripId'],
-                vehicle['currentStopSequence'], 
-                vehicle['currentStatus'], 
-                vehicle['position']['latitude'], 
-                vehicle['position']['longitude'], 
-                datetime.utcfromtimestamp(int(vehicle['timestamp']))
-            )
-            data_list.append(data)
-        with conn.cursor() as cur:
-            #psycopg2.extras.execute_values(cur, queryVehicle, paramsVehicle, page_size=200)
-            print('Inserting VehiclePositions...')
-            psycopg2.extras.execute_values(cur, queryVehiclePositions, data_list, page_size=200)
-            return True
-    return False
+def insertFeed(name, feed, conn, target):
+    # Each feed has a transaction of its own, so its latest-state rows are
+    # upserted once all of its batches are in
+    latest = Ingestion.LatestRows(target.prefix) if LoaderConfig['latest'] else None
+    if Columnar.isUsed(LoaderConfig['mode'], ParquetExport):
+        inserted = Columnar.insertFeed(name, feed, conn, TripUpdateIds, target.tripDedup,
+            LoaderConfig['batchsize'], latest, ParquetExport, target.staticGtfs, target.prefix)
+    else:
+        inserted = Ingestion.insertFeed(name, feed, conn, TripUpdateIds, LoaderConfig['mode'],
+            target.tripDedup, LoaderConfig['batchsize'], latest, target.staticGtfs, target.prefix)
+    if latest is not None:
+        latest.upsert(conn)
+    return inserted
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,264 @@
+"""
+Write-behind buffer for the poller: rows of many snapshots are collected and
+inserted in one transaction once enough rows, or old enough ones, are
+waiting. Every batch of rows is appended to a journal file before it is
+acknowledged, and the journal is only dropped once its rows are committed,
+so rows buffered when the process dies are inserted on the next start.
+"""
+from threading import Condition
+from threading import Thread
+import logging
+import os
+import pickle
+import struct
+import time
+import psycopg2
+import DBLoader
+import Ingestion
+import Metrics
+
+CONFIG_SECTION_WRITE_BEHIND = 'writebehind'
+WRITE_BEHIND_DEFAULTS = {
+    'enabled': True,
+    # A flush starts when this many rows are buffered...
+    'flushrows': 20000,
+    # ...or when the oldest buffered rows are this many seconds old
+    'flushseconds': 10.0,
+    # Adding rows blocks while this many are waiting, so a slow database
+    # slows the poller down instead of filling the memory
+    'maxrows': 200000,
+    'journal': 'writebehind.journal'
+}
+FLUSHING_SUFFIX = '.flushing'
+# Batches that cannot be inserted are moved there, in the journal format
+DEAD_LETTER_SUFFIX = '.deadletter'
+RECORD_LENGTH = struct.Struct('<I')
+RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 60.0
+# Lost connections, deadlocks, a database restarting: the same rows may go
+# through on the next attempt. Any other error would fail every time.
+TRANSIENT_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+log = logging.getLogger(__name__)
+
+class WriteBehindBuffer:
+    """
+    Buffers (trips, vehiclePositions) rows, as built by Ingestion, and
+    inserts them from a background thread. Trips have no trip_update_id yet;
+    IDs are reserved when they are flushed. With a Columnar.ParquetExport,
+    flushed rows are also written as Parquet. Rows go to the tables named
+    with tablePrefix, so each prefix needs its own buffer.
+    """
+    def __init__(self, dbPool, tripUpdateIds, loaderMode, flushRows, flushSeconds,
+                 maxRows, journalPath, latest=False, export=None, tablePrefix=''):
+        self.dbPool = dbPool
+        self.tripUpdateIds = tripUpdateIds
+        self.loaderMode = loaderMode
+        self.latest = latest
+        self.export = export
+        self.tablePrefix = tablePrefix
+        self.database = export is None or export.database
+        self.flushRows = max(1, int(flushRows))
+        self.flushSeconds = flushSeconds
+        self.maxRows = max(self.flushRows, int(maxRows))
+        self.journalPath = journalPath
+        self.flushingPath = journalPath + FLUSHING_SUFFIX
+        self.deadLetterPath = journalPath + DEAD_LETTER_SUFFIX
+        self.condition = Condition()
+        self.trips = []
+        self.vehiclePositions = []
+        self.rows = 0
+        self.oldest = None
+        # Rows taken by the flusher and not committed yet
+        self.inflightRows = 0
+        self.closing = False
+        self.failed = None
+        self.replay()
+        self.journal = open(self.journalPath, 'ab')
+        self.thread = Thread(target=self._run, name='write-behind')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def replay(self):
+        """Buffers the rows journaled but not committed by a previous run."""
+        for path in (self.flushingPath, self.journalPath):
+            if not os.path.exists(path):
+                continue
+            count = 0
+            for trips, vehiclePositions in readJournal(path):
+                self._append(trips, vehiclePositions)
+                count += 1
+            if count:
+                log.info("Replaying %d buffered snapshots from %s", count, path)
+        if self.rows:
+            # Written back as one journal so nothing is lost if the replay
+            # itself is interrupted
+            with open(self.journalPath + '.tmp', 'wb') as journal:
+                writeRecord(journal, (self.trips, self.vehiclePositions))
+            os.replace(self.journalPath + '.tmp', self.journalPath)
+        if os.path.exists(self.flushingPath):
+            os.remove(self.flushingPath)
+
+    def add(self, trips, vehiclePositions):
+        """
+        Journals and buffers the rows of a snapshot. Blocks while the buffer is
+        full, and raises if the flusher stopped.
+        """
+        count = countRows(trips, vehiclePositions)
+        if count == 0:
+            return
+        with self.condition:
+            while self.rows + self.inflightRows >= self.maxRows and self.failed is None:
+                Metrics.increment('write_behind_waits_total')
+                self.condition.wait()
+            if self.failed is not None:
+                raise self.failed
+            writeRecord(self.journal, (trips, vehiclePositions))
+            self._append(trips, vehiclePositions)
+            self.condition.notify_all()
+
+    def _append(self, trips, vehiclePositions):
+        self.trips.extend(trips)
+        self.vehiclePositions.extend(vehiclePositions)
+        self.rows += countRows(trips, vehiclePositions)
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+    def _due(self):
+        if self.rows == 0:
+            return False
+        return self.closing or self.rows >= self.flushRows \
+            or time.monotonic() - self.oldest >= self.flushSeconds
+
+    def _take(self):
+        # Hands the buffered rows to the flusher, and starts a new journal
+        # for the rows added while they are inserted.
+        trips, vehiclePositions = self.trips, self.vehiclePositions
+        self.inflightRows = self.rows
+        self.trips, self.vehiclePositions = [], []
+        self.rows = 0
+        self.oldest = None
+        self.journal.close()
+        os.replace(self.journalPath, self.flushingPath)
+        self.journal = open(self.journalPath, 'ab')
+        return trips, vehiclePositions
+
+    def _run(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self._due():
+                        if self.closing:
+                            return
+                        timeout = None
+                        if self.oldest is not None:
+                            timeout = max(0, self.flushSeconds - (time.monotonic() - self.oldest))
+                        self.condition.wait(timeout)
+                    trips, vehiclePositions = self._take()
+                self._flushWithRetries(trips, vehiclePositions)
+                os.remove(self.flushingPath)
+                with self.condition:
+                    self.inflightRows = 0
+                    self.condition.notify_all()
+        except Exception as e:
+            log.exception("Write-behind flusher failed")
+            with self.condition:
+                self.failed = e
+                self.condition.notify_all()
+
+    def _flushWithRetries(self, trips, vehiclePositions):
+        # The same rows are retried until they are committed; new rows keep
+        # being buffered meanwhile, up to maxrows. Rows the database rejects
+        # would block every later row, across restarts too, so they are set
+        # aside instead.
+        delay = RETRY_DELAY
+        while True:
+            try:
+                self.flush(trips, vehiclePositions)
+                return
+            except TRANSIENT_ERRORS as e:
+                if self.closing and delay >= MAX_RETRY_DELAY:
+                    raise
+                Metrics.increment('retries_total', error=type(e).__name__)
+                log.warning("Flush failed: %s, retrying in %.0fs", e, delay)
+                time.sleep(delay)
+                delay = min(MAX_RETRY_DELAY, delay * 2)
+            except Exception as e:
+                self.deadLetter(trips, vehiclePositions, e)
+                return
+
+    def deadLetter(self, trips, vehiclePositions, error):
+        with open(self.deadLetterPath, 'ab') as deadLetters:
+            writeRecord(deadLetters, (trips, vehiclePositions))
+        Metrics.increment('write_behind_dead_letters_total', error=type(error).__name__)
+        log.error("Flush failed: %s, moved %d rows to %s", error,
+            countRows(trips, vehiclePositions), self.deadLetterPath)
+
+    def flush(self, trips, vehiclePositions):
+        with Metrics.timed('flush'), self.dbPool.transaction() as conn:
+            paramsTripUpdate, paramsStopUpdate = Ingestion.assignTripUpdateIds(
+                trips, conn, self.tripUpdateIds)
+            if self.database:
+                with conn.cursor() as cur:
+                    for table, columns, rows in (
+                            (DBLoader.TRIP_UPDATE_TABLE, DBLoader.TRIP_UPDATE_COLUMNS, paramsTripUpdate),
+                            (DBLoader.STOP_TIME_UPDATE_TABLE, DBLoader.STOP_TIME_UPDATE_COLUMNS, paramsStopUpdate),
+                            (DBLoader.VEHICLE_POSITION_TABLE, DBLoader.VEHICLE_POSITION_COLUMNS, vehiclePositions)):
+                        DBLoader.loadRows(cur, DBLoader.prefixedTable(table, self.tablePrefix), columns,
+                            rows, self.loaderMode)
+                if self.latest:
+                    latest = Ingestion.LatestRows(self.tablePrefix)
+                    latest.addStopTimes(paramsTripUpdate, paramsStopUpdate)
+                    latest.addVehicles(vehiclePositions)
+                    latest.upsert(conn)
+            if self.export is not None:
+                self.export.writeRows(DBLoader.TRIP_UPDATE_TABLE, paramsTripUpdate, self.tablePrefix)
+                self.export.writeRows(DBLoader.STOP_TIME_UPDATE_TABLE, paramsStopUpdate, self.tablePrefix)
+                self.export.writeRows(DBLoader.VEHICLE_POSITION_TABLE, vehiclePositions, self.tablePrefix)
+        Metrics.increment('write_behind_flushes_total')
+        log.info("Flushed %d trip updates and %d vehicle positions",
+            len(paramsTripUpdate), len(vehiclePositions))
+
+    def close(self):
+        """Flushes the buffered rows and stops the flusher."""
+        with self.condition:
+            self.closing = True
+            self.condition.notify_all()
+        self.thread.join()
+        self.journal.close()
+        if self.failed is None and self.rows == 0 and os.path.getsize(self.journalPath) == 0:
+            os.remove(self.journalPath)
+
+def createWriteBehind(config, dbPool, tripUpdateIds, loaderMode, latest=False, export=None,
+                      tablePrefix=''):
+    if not config['enabled']:
+        return None
+    # The buffer of a table prefix journals next to the default one, e.g.
+    # rtm_writebehind.journal
+    folder, journal = os.path.split(config['journal'])
+    return WriteBehindBuffer(dbPool, tripUpdateIds, loaderMode, config['flushrows'],
+        config['flushseconds'], config['maxrows'], os.path.join(folder, tablePrefix + journal),
+        latest, export, tablePrefix)
+
+def countRows(trips, vehiclePositions):
+    return sum(1 + len(stopUpdates) for tripUpdate, stopUpdates in trips) + len(vehiclePositions)
+
+def writeRecord(journal, record):
+    data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+    journal.write(RECORD_LENGTH.pack(len(data)))
+    journal.write(data)
+    journal.flush()
+    os.fsync(journal.fileno())
+
+def readJournal(path):
+    # A record cut short by a crash is the last one and was never
+    # acknowledged, so it is dropped.
+    with open(path, 'rb') as journal:
+        while True:
+            header = journal.read(RECORD_LENGTH.size)
+            if len(header) < RECORD_LENGTH.size:
+                return
+            data = journal.read(RECORD_LENGTH.unpack(header)[0])
+            if len(data) < RECORD_LENGTH.unpack(header)[0]:
+                return
+            yield pickle.loads(data)